@@ -2,7 +2,14 @@
 Handles flash programming Kinetis devices
 """
 
+import os
 import re
+import csv
+import bisect
+import json
+import struct
+import time
+import zlib
 
 class IntelHexException(Exception):
     def __init__(self, message):
@@ -12,6 +19,18 @@ class InvalidDataException(Exception):
     def __init__(self, message):
         super(Exception, self).__init__(message)
 
+class TransactionBudgetError(Exception):
+    def __init__(self, message):
+        super(Exception, self).__init__(message)
+
+class LoaderException(Exception):
+    def __init__(self, message):
+        super(Exception, self).__init__(message)
+
+class VerifyException(Exception):
+    def __init__(self, message):
+        super(Exception, self).__init__(message)
+
 class HexLine(object):
     def __init__(self, s):
         vals = [int(s[i:i+2], 16) for i in range(0, len(s), 2)]
@@ -100,6 +119,169 @@ def aggregate_addr_data(addrdata, max_length=256):
         yield (current_addr, current_data)
 
 
+CONFIG_FIELD_START = 0x400
+CONFIG_FIELD_END = 0x410
+
+LOADER_TIMEOUT = 2.0 # seconds a single loader command may take
+
+MAILBOX_BUFFER_SIZE = 256 # bytes, see APIState.buffer in firmware/API.md
+
+RLE_MIN_RUN = 3
+RLE_MAX_RUN = 0x7F + RLE_MIN_RUN
+RLE_MAX_LITERAL = 0x80
+RLE_RUN = re.compile(b'(.)\\1{%d,}' % (RLE_MIN_RUN - 1), re.S)
+
+def rle_compress(data):
+    """
+    Compresses data with the run length encoding decoded by the loader
+    firmware. A control byte with bit 7 set is followed by one byte which is
+    repeated (control & 0x7F) + 3 times. Otherwise it is followed by
+    control + 1 literal bytes.
+    """
+    data = bytes(data)
+    out = bytearray()
+    def literal(lo, hi):
+        for i in range(lo, hi, RLE_MAX_LITERAL):
+            n = min(hi - i, RLE_MAX_LITERAL)
+            out.append(n - 1)
+            out.extend(data[i:i + n])
+    pos = 0
+    for match in RLE_RUN.finditer(data):
+        literal(pos, match.start())
+        (pos, end) = match.span()
+        while end - pos >= RLE_MIN_RUN:
+            n = min(end - pos, RLE_MAX_RUN)
+            out.append(0x80 | (n - RLE_MIN_RUN))
+            out.append(data[pos])
+            pos += n
+    literal(pos, len(data))
+    return bytes(out)
+
+class FlashGeometry(object):
+    def __init__(self, flash_size, sector_size, phrase_size):
+        """
+        Describes the program flash of a device
+        flash_size: Size of the program flash in bytes
+        sector_size: Size of the smallest erasable unit in bytes
+        phrase_size: Size of the smallest programmable unit in bytes
+        """
+        self.flash_size = flash_size
+        self.sector_size = sector_size
+        self.phrase_size = phrase_size
+
+    def sector(self, addr):
+        """
+        Returns the address of the sector containing addr
+        """
+        return addr - (addr % self.sector_size)
+
+FLASH_GEOMETRY = {
+    'KE04': FlashGeometry(8 * 1024, 512, 8),
+    'KL26Z32': FlashGeometry(32 * 1024, 1024, 4),
+}
+
+# Location of the register identifying the device, SIM_SRSID on the KE04 and
+# SIM_SDID on the KL26
+DEVICE_ID_ADDR = {
+    'KE04': 0x40048000,
+    'KL26Z32': 0x40048024,
+}
+
+def plan_sector_erase(addrdata, geometry):
+    """
+    Computes the minimal set of sectors touched by the passed data
+    Returns a sequence of tuples of the first sector address and the number of
+    contiguous sectors to erase from there
+    """
+    sectors = set()
+    for (addr, data) in addrdata:
+        if not data:
+            continue
+        if addr + len(data) > geometry.flash_size:
+            raise InvalidDataException("Data at {0:x} is outside of flash"\
+                .format(addr))
+        first = geometry.sector(addr)
+        last = geometry.sector(addr + len(data) - 1)
+        sectors.update(range(first, last + 1, geometry.sector_size))
+    start = None
+    count = 0
+    for sector in sorted(sectors):
+        if start is not None and sector == start + count * geometry.sector_size:
+            count += 1
+            continue
+        if start is not None:
+            yield (start, count)
+        start = sector
+        count = 1
+    if start is not None:
+        yield (start, count)
+
+def split_config_field(addrdata, config):
+    """
+    Removes the flash configuration field from the passed data
+    Returns a tuple of the remaining data and the 16 bytes to program into the
+    configuration field, starting from config and overlaid with any data from
+    the image which falls within the field
+    """
+    config = list(config)
+    remaining = []
+    for (addr, data) in addrdata:
+        end = addr + len(data)
+        if end <= CONFIG_FIELD_START or addr >= CONFIG_FIELD_END:
+            remaining.append((addr, data))
+            continue
+        for a in range(max(addr, CONFIG_FIELD_START), min(end, CONFIG_FIELD_END)):
+            config[a - CONFIG_FIELD_START] = data[a - addr]
+        if addr < CONFIG_FIELD_START:
+            remaining.append((addr, data[:CONFIG_FIELD_START - addr]))
+        if end > CONFIG_FIELD_END:
+            remaining.append((CONFIG_FIELD_END, data[CONFIG_FIELD_END - addr:]))
+    return (remaining, config)
+
+def plan_transfers(addrdata, geometry, buffer_size=MAILBOX_BUFFER_SIZE,
+    max_gap=32, barriers=((CONFIG_FIELD_START, CONFIG_FIELD_END),)):
+    """
+    Plans the mailbox transfers for programming the passed data
+
+    Segments separated by less than max_gap bytes are merged by filling the gap
+    with 0xFF, which leaves erased flash unchanged, except across a barrier
+    such as the flash configuration field. Every transfer is aligned to the
+    phrase size, does not cross a sector and fits the loader buffer. Transfers
+    are returned in address order so that each sector is finished before the
+    next is started.
+
+    Returns a list of tuples of address and bytearray
+    """
+    phrase = geometry.phrase_size
+    merged = []
+    for (addr, data) in sorted((a, d) for (a, d) in addrdata if len(d)):
+        lo = addr - addr % phrase
+        hi = -(-(addr + len(data)) // phrase) * phrase
+        if merged:
+            (start, buf) = merged[-1]
+            end = start + len(buf)
+            # sharing a phrase forces a merge, otherwise the gap decides
+            if lo < end or (lo - end < max_gap and not any(
+                b_lo < lo and b_hi > end for (b_lo, b_hi) in barriers)):
+                if hi > end:
+                    buf.extend(b'\xff' * (hi - end))
+                buf[addr - start:addr - start + len(data)] = data
+                continue
+        buf = bytearray(b'\xff' * (hi - lo))
+        buf[addr - lo:addr - lo + len(data)] = data
+        merged.append((lo, buf))
+
+    transfers = []
+    for (start, buf) in merged:
+        pos = start
+        end = start + len(buf)
+        while pos < end:
+            sector_end = geometry.sector(pos) + geometry.sector_size
+            limit = min(end, pos + buffer_size, sector_end)
+            transfers.append((pos, buf[pos - start:limit - start]))
+            pos = limit
+    return transfers
+
 def read_map_raw(name):
     """
     Reads a GCC map file to get addresses of sections
@@ -118,35 +300,259 @@ def read_map(name):
     """
     return dict(read_map_raw(name))
 
-def extract_bytes(words):
-    for w in words:
-        yield w & 0xFF
-        yield (w >> 8) & 0xFF
-        yield (w >> 16) & 0xFF
-        yield (w >> 24) & 0xFF
+def read_map_symbols(name):
+    """
+    Reads a GCC map file to get addresses of symbols, which are listed below
+    their input section as a line of just an address and a name
+    Returns a dictionary
+    """
+    SYMBOL_LINE_FORMAT = re.compile(r'^\s+0x([\da-f]+)\s+([A-Za-z_][\w.$]*)\s*$',
+        re.M)
+    with open(name) as f:
+        return dict((match.group(2), int(match.group(1), 16)) for match in \
+            SYMBOL_LINE_FORMAT.finditer(f.read()))
+
+def flatten_addr_data(addrdata, fill=0xFF):
+    """
+    Flattens address/data tuples into a single contiguous image
+
+    Returns a tuple of the base address and a bytearray with any gaps filled
+    """
+    chunks = list(addrdata)
+    if not chunks:
+        return (0, bytearray())
+    base = min(addr for (addr, data) in chunks)
+    end = max(addr + len(data) for (addr, data) in chunks)
+    image = bytearray([fill]) * (end - base)
+    for (addr, data) in chunks:
+        image[addr - base:addr - base + len(data)] = bytes(data)
+    return (base, image)
+
+class FlashImage(object):
+    def __init__(self, addrdata):
+        """
+        Holds an image as a list of chunks with a checksum for each
+        addrdata: Sequence of address/data tuples
+        """
+        self.chunks = [(addr, bytearray(data)) for (addr, data) in addrdata]
+        self.chunks.sort(key=lambda c: c[0])
+        self.__starts = [addr for (addr, data) in self.chunks]
+        self.crcs = [zlib.crc32(data) & 0xFFFFFFFF for (addr, data) in \
+            self.chunks]
+
+    def __str__(self):
+        return "<FlashImage chunks={0} bytes={1}>".format(len(self.chunks),
+            sum(len(data) for (addr, data) in self.chunks))
+
+    @staticmethod
+    def from_hex(name):
+        """
+        Parses an intel hex file into an image
+        """
+        return FlashImage(aggregate_addr_data(parse_intel_hex(name)))
+
+    def copy(self):
+        """
+        Returns a copy which may be patched without changing this image
+        """
+        image = FlashImage([])
+        image.chunks = [(addr, bytearray(data)) for (addr, data) in self.chunks]
+        image.__starts = list(self.__starts)
+        image.crcs = list(self.crcs)
+        return image
+
+    def patch(self, addr, data):
+        """
+        Overwrites the image at addr with data in place, re-checksumming only
+        the chunks which were touched
+        """
+        end = addr + len(data)
+        covered = 0
+        i = max(bisect.bisect_right(self.__starts, addr) - 1, 0)
+        while i < len(self.chunks) and self.chunks[i][0] < end:
+            (start, chunk) = self.chunks[i]
+            lo = max(addr, start)
+            hi = min(end, start + len(chunk))
+            if lo < hi:
+                chunk[lo - start:hi - start] = data[lo - addr:hi - addr]
+                self.crcs[i] = zlib.crc32(chunk) & 0xFFFFFFFF
+                covered += hi - lo
+            i += 1
+        if covered != len(data):
+            raise InvalidDataException("Patch at {0:x} is not within the image"\
+                .format(addr))
+
+PATCH_FORMATS = {
+    'u8': '<B',
+    'u16': '<H',
+    'u32': '<I',
+    'u64': '<Q',
+    'be16': '>H',
+    'be32': '>I',
+    'be64': '>Q',
+}
+
+class PatchTemplate(object):
+    def __init__(self, fields):
+        """
+        Describes where per-unit values are patched into an image
+        fields: Sequence of tuples of the field name, address, format and
+            length. The format is one of PATCH_FORMATS, 'bytes' for a hex
+            string or 'ascii' for text padded with zeros. The length is only
+            used by 'bytes' and 'ascii'.
+        """
+        self.fields = list(fields)
+
+    @staticmethod
+    def from_json(name, mapname=None):
+        """
+        Reads a template from a json file of the form
+        { "serial": { "address": "0x1f00", "format": "u32" },
+          "mac": { "symbol": "mac_address", "format": "bytes", "length": 6 } }
+        Symbols are looked up in the passed gcc map file, falling back to
+        section names.
+        """
+        with open(name) as f:
+            spec = json.load(f)
+        mapfile = {}
+        if mapname is not None:
+            mapfile.update(read_map(mapname))
+            mapfile.update(read_map_symbols(mapname))
+        fields = []
+        for (field, entry) in sorted(spec.items()):
+            if 'symbol' in entry:
+                if entry['symbol'] not in mapfile:
+                    raise InvalidDataException("Unknown symbol {0}".format(
+                        entry['symbol']))
+                addr = mapfile[entry['symbol']]
+            else:
+                addr = int(str(entry['address']), 0)
+            if entry['format'] in ('bytes', 'ascii') and \
+                entry.get('length') is None:
+                raise InvalidDataException("Field {0} needs a length".format(
+                    field))
+            fields.append((field, addr, entry['format'], entry.get('length')))
+        return PatchTemplate(fields)
+
+    @staticmethod
+    def encode(format, length, value):
+        """
+        Encodes a value, given as a string or already converted, in a format
+        """
+        if format in PATCH_FORMATS:
+            if not isinstance(value, int):
+                value = int(value, 0)
+            return struct.pack(PATCH_FORMATS[format], value)
+        elif format == 'bytes':
+            data = bytes.fromhex(value) if isinstance(value, str) else \
+                bytes(value)
+        elif format == 'ascii':
+            data = value.encode('ascii') if isinstance(value, str) else \
+                bytes(value)
+            data += bytes(max(length - len(data), 0))
+        else:
+            raise InvalidDataException("Unknown format {0}".format(format))
+        if len(data) != length:
+            raise InvalidDataException("Value {0} is not {1} bytes".format(
+                value, length))
+        return data
+
+    def apply(self, image, values):
+        """
+        Patches the per-unit values, a dictionary keyed by field name, into
+        the image in place
+        """
+        for (field, addr, format, length) in self.fields:
+            if field not in values:
+                raise InvalidDataException("No value for {0}".format(field))
+            image.patch(addr, PatchTemplate.encode(format, length,
+                values[field]))
+
+def read_units(stream):
+    """
+    Reads per-unit values from a csv stream with a header row naming the
+    template fields. Rows are yielded as they arrive so that a stream may be
+    fed one unit at a time.
+    """
+    for row in csv.DictReader(stream):
+        yield row
 
 class FlashProgrammer(object):
-    def __init__(self, dev, type):
+    def __init__(self, dev, type, lean=False, budget=None, compress=True,
+        verify=False, firmware_dir='firmware'):
         """
         Initializes the flash programmer
         dev: The device to program
         type: The string type name of the device
+        lean: Perform only the transactions needed to program the device,
+            skipping all diagnostic reads
+        budget: Optional dictionary of the maximum number of SWD transactions
+            each phase of programming may use
+        compress: Send blocks compressed when the firmware supports it and
+            doing so saves wire bytes
+        verify: Read the flash back after programming and compare the checksum
+            of each chunk of the image
+        firmware_dir: Directory holding the loader builds for each type
         """
         self.dev = dev
         self.type = type
-        mapfile = read_map('firmware/' + self.type + '/bin/firmware.map')
+        self.lean = lean
+        self.budget = budget
+        self.compress = compress
+        self.verify = verify
+        self.__wire = { 'data': 0, 'sent': 0, 'skipped': 0 }
+        self.geometry = FLASH_GEOMETRY.get(self.type)
+        bindir = os.path.join(firmware_dir, self.type, 'bin')
+        mapfile = read_map(os.path.join(bindir, 'firmware.map'))
         self.__table_offset = mapfile['interrupt_vector_table']
         self.__flash_api_loc = mapfile['flash_api_state']
         self.__unsecured_config_loc = mapfile['unsecured_config']
+        # older loader builds do not carry a stamp and are always uploaded
+        self.__loader_stamp_loc = mapfile.get('loader_stamp')
+        self.__loader = list(aggregate_addr_data(parse_intel_hex(
+            os.path.join(bindir, 'firmware.hex'))))
+        (base, image) = flatten_addr_data(self.__loader, fill=0x00)
+        self.__loader_base = base
+        self.__loader_image = image
+        # Only the region below the API state is checksummed. Everything
+        # from there up is modified by the loader while it runs.
+        self.__loader_checked = image[:self.__flash_api_loc - base]
+        self.__loader_crc = zlib.crc32(self.__loader_checked) & 0xFFFFFFFF
+        self.__loader_readback = bytearray(len(self.__loader_checked))
+        self.__loader_hash = zlib.crc32(
+            base.to_bytes(4, 'little') + bytes(image)) & 0xFFFFFFFF
 
-    def program(self, filename):
+    def profile(self):
         """
-        Programs the passed hex file to the device
+        Returns the device profile, read once per session. The device drops
+        it on reconnect since that may be to a different board.
         """
+        session = self.dev.session
+        if 'profile' not in session:
+            id_addr = DEVICE_ID_ADDR.get(self.type)
+            session['profile'] = {
+                'ahb_idcode': self.dev.ahb.idcode(),
+                'mdm_idcode': self.dev.mdm.idcode(),
+                'sdid': None if id_addr is None else \
+                    self.dev.ahb.readWord(id_addr),
+                'geometry': self.geometry,
+            }
+        return session['profile']
 
+    def program(self, filename):
+        """
+        Programs the passed hex file, FlashImage or prepared image to the device
+
+        Returns a dictionary of the number of SWD transactions used by each
+        phase of programming
+        """
+        dp = self.dev.dp
+        dp.transactions.clear()
+        dp.phase('connect')
 
-        print("Device: {0}\n\tIVT: {1:x}\n\tAPI: {2:x}".format(
-            self.type, self.__table_offset, self.__flash_api_loc))
+        if not self.lean:
+            print("Device: {0}\n\tIVT: {1:x}\n\tAPI: {2:x}".format(
+                self.type, self.__table_offset, self.__flash_api_loc))
 
         if self.dev.is_secured():
             print("Device reports that it is secure. Attempting to unsecure...")
@@ -154,95 +560,355 @@ class FlashProgrammer(object):
                 print("Device is still secure. Aborting.")
                 return
 
-        print(self.dev)
-        print("{0:x}".format(self.dev.mdm.status()))
-        print(self.dev.status())
-        self.dev.set_debug()
-        print("SIM_SRSID", hex(self.dev.ahb.readWord(0x40048000)))
-        self.dev.reset() # this eventually halts the processor
-        print(self.dev.status())
-        print(self.dev)
+        profile = self.profile()
+        if not self.lean:
+            print(self.dev)
+            print("{0:x}".format(self.dev.mdm.status()))
+            print(self.dev.status())
+            if profile['sdid'] is not None:
+                print("SDID", hex(profile['sdid']))
+        # enables debug and halts on the reset vector
+        dhcsr = self.dev.reset()
+        if not self.lean:
+            print("DHCSR after reset: 0x{0:x}".format(dhcsr))
+
+        dp.phase('load')
+        self.__load_firmware()
+        if not self.lean:
+            print(self.dev.status())
+        self.__start_loader()
+        if not self.lean:
+            print(self.dev.status())
+
+        try:
+            dp.phase('erase')
+            if isinstance(filename, str):
+                source = FlashImage.from_hex(filename)
+            else:
+                source = filename
+            image = source.chunks
+            # images prepared ahead of time come planned and compressed
+            planned = getattr(filename, 'planned', False)
+            packed = getattr(filename, 'packed', {})
+            config_erased = self.__erase(image)
+            (image, config) = split_config_field(image, self.__unsecured_config())
+            if self.geometry is not None and not planned:
+                # each chunk split on its own to fit the mailbox buffer
+                naive = sum(-(-len(data) // MAILBOX_BUFFER_SIZE) for \
+                    (addr, data) in image)
+                image = plan_transfers(image, self.geometry)
+                print("Transfer plan: {0} mailbox transactions instead of {1}, "\
+                    "{2} saved".format(len(image), naive, naive - len(image)))
+            dp.phase('program')
+            for k in self.__wire:
+                self.__wire[k] = 0
+            print("Programming {0}...".format(filename))
+            for (addr, data) in image:
+                print("\tWriting {0} bytes to {1:x}".format(len(data), addr))
+                self.__program_flash(addr, data, packed.get((addr, len(data))))
+            if config_erased:
+                print("\tWriting flash configuration")
+                self.__program_flash(CONFIG_FIELD_START, config)
+            self.__report_wire()
+            if self.verify:
+                dp.phase('verify')
+                self.__verify(source)
+        except:
+            dp.phase('recover')
+            print("An error occurred. Erasing and unsecuring flash...")
+            try:
+                self.__recover()
+                print("Done.")
+            except Exception as e:
+                # the original error is the one worth reporting
+                print("Recovery failed: {0}".format(e))
+            raise
+
+        if not self.lean:
+            print("After programming, the flash configuration is:")
+            for i in [0x400, 0x404, 0x408, 0x40C]:
+                print("{0:x}: {1:x}".format(i, self.dev.ahb.readWord(i)))
+
+        dp.phase('reset')
+        self.dev.reset(halt=False)
+
+        transactions = dict(dp.transactions)
+        print("SWD transactions: " + ", ".join("{0} {1}".format(k, v) for \
+            (k, v) in transactions.items()))
+        self.__check_budget(transactions)
+        return transactions
+
+    def __check_budget(self, transactions):
+        """
+        Raises TransactionBudgetError if any phase used more transactions than
+        the budget allows
+        """
+        if self.budget is None:
+            return
+        over = ["{0} used {1} of {2}".format(k, v, self.budget[k]) for \
+            (k, v) in transactions.items() if k in self.budget and \
+            v > self.budget[k]]
+        if over:
+            raise TransactionBudgetError("Transaction budget exceeded: " + \
+                ", ".join(over))
+
+    def __loader_vectors(self):
+        """
+        Returns the initial stack pointer and reset vector of the loader,
+        taken from the host copy of the image rather than read back
+        """
+        off = self.__table_offset - self.__loader_base
+        table = self.__loader_image[off:off + 8]
+        return (int.from_bytes(table[0:4], 'little'),
+            int.from_bytes(table[4:8], 'little'))
+
+    def __unsecured_config(self):
+        """
+        Returns the unsecured flash configuration from the host copy of the
+        loader image
+        """
+        off = self.__unsecured_config_loc - self.__loader_base
+        return list(self.__loader_image[off:off + 16])
+
+    def __loader_resident(self):
+        """
+        Determines if this exact loader is already resident in RAM by checking
+        its stamp and the checksum of the loaded region
+        """
+        if self.__loader_stamp_loc is None:
+            return False
+        stamp = self.dev.ahb.readBlock(self.__loader_stamp_loc, 2)
+        if stamp != [self.__loader_hash, self.__loader_crc]:
+            return False
+        return self.__loaded_crc() == self.__loader_crc
+
+    def __loaded_crc(self):
+        """
+        Computes the checksum of the loader region as it is currently in RAM
+        """
+        self.dev.read_into(self.__loader_base, self.__loader_readback)
+        return zlib.crc32(self.__loader_readback) & 0xFFFFFFFF
+
+    def __load_firmware(self):
+        """
+        Loads the loader firmware into RAM unless it is already resident
+        """
+        if self.__loader_resident():
+            print("{0} firmware already resident, skipping upload.".format(
+                self.type))
+            # clear any stale ready flag until the loader restarts
+            self.dev.ahb.writeWord(self.__flash_api_loc, 0x00)
+            return
         print("Loading {0} firmware into memory...".format(self.type))
-        for (addr, data) in aggregate_addr_data(parse_intel_hex('firmware/' + self.type + '/bin/firmware.hex')):
+        if self.__loader_stamp_loc is not None:
+            self.dev.ahb.writeBlockFast(self.__loader_stamp_loc, [0, 0])
+        for (addr, data) in self.__loader:
             print("\tWriting {0} bytes to {1:x}".format(len(data), addr))
-            self.dev.write_to_ram(addr, data)
+            self.dev.write_to_ram(addr, list(data))
+        if self.__loaded_crc() != self.__loader_crc:
+            raise InvalidDataException("Loader firmware failed verification")
+        if self.__loader_stamp_loc is not None:
+            self.dev.ahb.writeBlockFast(self.__loader_stamp_loc,
+                [self.__loader_hash, self.__loader_crc])
         print("Firmware loaded.")
-        print(self.dev.status())
-        stack_top = self.dev.ahb.readWord(self.__table_offset)
-        reset_vec = self.dev.ahb.readWord(self.__table_offset + 4)
+
+    def __start_loader(self):
+        """
+        Starts the halted core on the loader firmware in RAM
+        """
+        (stack_top, reset_vec) = self.__loader_vectors()
         print("\tSP: 0x{0:x}".format(stack_top))
         print("\tReset vector: 0x{0:x}".format(reset_vec))
         self.dev.registers(reg=0xd, value=stack_top)
         self.dev.registers(reg=0xf, value=reset_vec)
         self.dev.run()
         self.dev.wait_flash()
-        print(self.dev.status())
-
-        try:
-            self.__mass_erase()
-            print("Programming {0}...".format(filename))
-            for (addr, data) in aggregate_addr_data(parse_intel_hex(filename)):
-                print("\tWriting {0} bytes to {1:x}".format(len(data), addr))
-                self.__program_flash(addr, data)
-        except:
-            print("An error occurred. Erasing and unsecuring flash...")
-            self.__mass_erase()
-            self.__program_flash(0x400, list(extract_bytes(self.dev.ahb.readBlock(self.__unsecured_config_loc, 4))))
-            print("Done.")
-            raise
-
-        print("After programming, the flash configuration is:")
-        for i in [0x400, 0x404, 0x408, 0x40C]:
-            print("{0:x}: {1:x}".format(i, self.dev.ahb.readWord(i)))
 
+    def __restart_loader(self):
+        """
+        Restarts the loader which is still resident in RAM. Older loader builds
+        stop responding once they have reported a command as not implemented.
+        """
+        print("Restarting firmware...")
         self.dev.reset()
-        self.dev.run()
+        # clear the stale ready flag until the loader has started again
+        self.dev.ahb.writeWord(self.__flash_api_loc, 0x00)
+        self.__start_loader()
 
-    def __wait_ready(self):
+    def __wait_ready(self, timeout=LOADER_TIMEOUT):
         """
         Waits for the firmware to become ready
+
+        Returns the firmware status
+        """
+        deadline = time.perf_counter() + timeout
+        while True:
+            status = self.dev.ahb.readWord(self.__flash_api_loc)
+            if status & 0x8:
+                return status
+            if time.perf_counter() > deadline:
+                raise LoaderException("Firmware did not become ready within "\
+                    "{0}s, status {1:x}".format(timeout, status))
+
+    def __ready(self):
         """
-        while not self.dev.ahb.readWord(self.__flash_api_loc) & 0x8:
-            i = 0
-        return self.dev.ahb.readWord(self.__flash_api_loc)
+        Waits for the firmware to accept a command. An error left by an earlier
+        command is reported but does not stop the loader accepting the next.
+        """
+        status = self.__wait_ready()
+        if (status & 0xF0):
+            print("Previous command left status {0:x}".format(status))
+
+    def __check(self, status, what):
+        """
+        Raises LoaderException if the firmware reports that a command failed
+
+        Returns the firmware status
+        """
+        if (status & 0xF0) and (status & 0xF0) != 0xF0:
+            raise LoaderException("{0} failed with status {1:x}".format(what,
+                status))
+        return status
 
     def __mass_erase(self):
         """
         Performs a mass erase operation via the firmware
         """
         print("Waiting for firmware to become ready...")
-        status = self.__wait_ready()
-        if (status & 0xF0):
-            print("There is an error pending: {0:x}".format(status))
-            return
+        self.__ready()
         print("Issuing erase command")
         self.dev.ahb.writeWord(self.__flash_api_loc, 0x00)
-        status = self.__wait_ready()
-        if (status & 0xF0):
-            print("There is an error pending: {0:x}".format(status))
-            return
+        status = self.__check(self.__wait_ready(), "Mass erase")
+        if (status & 0xF0) == 0xF0:
+            raise LoaderException("Mass erase not implemented by firmware")
         print("Mass erase complete")
 
-    def __program_flash(self, addr, data):
+    def __recover(self):
         """
-        Programs a set of data
+        Erases the flash and writes the unsecured flash configuration so that
+        the device is not left secured. When the firmware cannot mass erase,
+        only the sector holding the configuration field is erased.
         """
-        if any([d > 0xFF for d in data]):
-            raise InvalidDataException("Data contains values greater than 0xFF")
-        # pad array with zeros to be divisible by 4
-        if len(data) % 4:
-            data[len(data):] = [0] * (4 - (len(data) % 4))
+        # the loader may have stopped responding
+        self.__restart_loader()
+        try:
+            self.__mass_erase()
+        except LoaderException as e:
+            if self.geometry is None:
+                raise
+            print("{0}, erasing the flash configuration sector".format(e))
+            # older builds stop responding after a command not implemented
+            self.__restart_loader()
+            status = self.__erase_sectors(
+                self.geometry.sector(CONFIG_FIELD_START), 1)
+            if (status & 0xF0) == 0xF0:
+                raise LoaderException("Sector erase not implemented by "\
+                    "firmware")
+        self.__program_flash(CONFIG_FIELD_START, self.__unsecured_config())
+
+    def __erase(self, image):
+        """
+        Erases only the sectors touched by the passed image, falling back to a
+        mass erase when the geometry is unknown or the firmware does not
+        implement sector erase
+
+        Returns whether the flash configuration field was erased
+        """
+        if self.geometry is None:
+            self.__mass_erase()
+            return True
+        plan = list(plan_sector_erase(image, self.geometry))
+        print("Erasing {0} of {1} sectors".format(sum(c for (a, c) in plan),
+            self.geometry.flash_size // self.geometry.sector_size))
+        config_sector = self.geometry.sector(CONFIG_FIELD_START)
+        config_erased = False
+        for (addr, count) in plan:
+            status = self.__erase_sectors(addr, count)
+            if (status & 0xF0) == 0xF0:
+                print("Sector erase not implemented by firmware")
+                self.__restart_loader()
+                self.__mass_erase()
+                return True
+            if addr <= config_sector < addr + count * self.geometry.sector_size:
+                config_erased = True
+        return config_erased
 
-        # convert to 32-bit values for speed
-        a_data = [(data[i+3] << 24) + (data[i+2] << 16) + (data[i+1] << 8) + \
-            data[i] for i in range(0, len(data), 4)]
+    def __erase_sectors(self, addr, count):
+        """
+        Erases count sectors starting at addr via the firmware
 
+        Returns the firmware status after the command
+        """
+        self.__ready()
         self.dev.ahb.writeWord(self.__flash_api_loc + 4, addr)
-        self.dev.ahb.writeWord(self.__flash_api_loc + 8, len(a_data))
-        for i in range(0, len(a_data)):
-            self.dev.ahb.writeWord(self.__flash_api_loc + 12 + i * 4, a_data[i])
-        self.dev.ahb.writeWord(self.__flash_api_loc, 0x01)
-        status = self.__wait_ready()
-        if (status & 0xF0):
-            print("There is an error pending: {0:x}".format(status))
+        self.dev.ahb.writeWord(self.__flash_api_loc + 8, count)
+        self.dev.ahb.writeWord(self.__flash_api_loc, 0x03)
+        return self.__check(self.__wait_ready(), "Sector erase")
+
+    def __verify(self, image):
+        """
+        Reads each chunk of the image back from flash and compares it against
+        the checksum kept with the image
+        """
+        for ((addr, data), crc) in zip(image.chunks, image.crcs):
+            readback = bytearray(len(data))
+            self.dev.read_into(addr, readback)
+            if zlib.crc32(readback) & 0xFFFFFFFF != crc:
+                raise VerifyException("Verification failed for {0} bytes at "\
+                    "{1:x}".format(len(data), addr))
+        print("Verified {0} chunks".format(len(image.chunks)))
+
+    def __report_wire(self):
+        """
+        Reports how many bytes compression and skipping erased blocks saved
+        """
+        wire = self.__wire
+        if not wire['data']:
+            return
+        print("Sent {0} of {1} bytes ({2:.1%}), {3} bytes already erased, "\
+            "{4} wire bytes saved".format(wire['sent'], wire['data'],
+            wire['sent'] / float(wire['data']), wire['skipped'],
+            wire['data'] - wire['sent']))
+
+    def __program_flash(self, addr, data, packed=None):
+        """
+        Programs a set of data, compressed if that pays. Blocks which are all
+        0xFF are skipped since they are already erased. A compressed form
+        prepared ahead of time may be passed as packed.
+        """
+        try:
+            data = bytes(data)
+        except ValueError:
+            raise InvalidDataException("Data contains values greater than 0xFF")
+        # pad with zeros to be divisible by 4
+        if len(data) % 4:
+            data += bytes(4 - (len(data) % 4))
+        self.__wire['data'] += len(data)
+        if data.count(0xFF) == len(data):
+            self.__wire['skipped'] += len(data)
             return
+
+        if self.compress:
+            if packed is None:
+                packed = rle_compress(data)
+            if len(packed) < len(data) and len(packed) <= MAILBOX_BUFFER_SIZE:
+                status = self.__command(0x04, addr, len(data) // 4, packed)
+                if (status & 0xF0) != 0xF0:
+                    return
+                print("Compressed program not implemented by firmware")
+                self.compress = False
+                self.__restart_loader()
+        self.__command(0x01, addr, len(data) // 4, data)
+
+    def __command(self, cmd, addr, length, payload):
+        """
+        Loads the mailbox and executes a program command
+
+        Returns the firmware status after the command
+        """
+        # address, length and buffer are contiguous in the mailbox
+        self.dev.ahb.writeMem(self.__flash_api_loc + 4,
+            struct.pack('<II', addr, length) + payload)
+        self.dev.ahb.writeWord(self.__flash_api_loc, cmd)
+        self.__wire['sent'] += len(payload)
+        return self.__check(self.__wait_ready(), "Program")
@@ -0,0 +1,226 @@
+"""
+Host-side preparation of programming jobs
+
+Parsing hex files, applying per-unit patches, planning transfers and computing
+checksums is spread over a pool of processes. Each prepared job is handed back
+as chunk buffers and a CRC table in shared memory and fed to the SWD side
+through a bounded queue, so the link does not wait on the host.
+"""
+
+import queue
+import struct
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from FlashProgrammer import *
+
+class Job(object):
+    def __init__(self, name, type, hexfile, template=None, values=None):
+        """
+        Describes one image to prepare
+        name: Name used when reporting the job
+        type: The string type name of the device
+        hexfile: Path of the base hex file
+        template: Optional PatchTemplate applied with values
+        values: Dictionary of per-unit values for the template
+        """
+        self.name = name
+        self.type = type
+        self.hexfile = hexfile
+        self.template = template
+        self.values = values
+
+# pristine base images parsed by this worker process, keyed by file name
+_base_images = {}
+
+# a prepared block starts with the number of chunks and a table with the
+# address, offset, length, CRC and the offset and length of the compressed
+# form of each, followed by the chunk data
+TABLE_HEADER = struct.Struct('<I')
+TABLE_ENTRY = struct.Struct('<6I')
+
+def prepare_job(job):
+    """
+    Prepares a job in a worker process
+
+    Returns a tuple of the job and the name of the shared memory block holding
+    the chunks, their compressed forms where compressing pays, and the table
+    describing them
+    """
+    if job.hexfile not in _base_images:
+        _base_images[job.hexfile] = FlashImage.from_hex(job.hexfile)
+    image = _base_images[job.hexfile]
+    if job.template is not None:
+        image = image.copy()
+        job.template.apply(image, job.values)
+    geometry = FLASH_GEOMETRY.get(job.type)
+    if geometry is not None:
+        chunks = plan_transfers(image.chunks, geometry)
+    else:
+        chunks = [(addr, bytearray(data)) for (addr, data) in image.chunks]
+
+    packed = []
+    for (addr, data) in chunks:
+        rle = rle_compress(data) if len(data) % 4 == 0 else b''
+        if not 0 < len(rle) < len(data) or len(rle) > MAILBOX_BUFFER_SIZE or \
+            data.count(0xFF) == len(data):
+            rle = b''
+        packed.append(rle)
+
+    offset = TABLE_HEADER.size + TABLE_ENTRY.size * len(chunks)
+    shm = shared_memory.SharedMemory(create=True, size=offset +
+        sum(len(data) + len(rle) for ((addr, data), rle) in zip(chunks, packed)))
+    TABLE_HEADER.pack_into(shm.buf, 0, len(chunks))
+    for (i, ((addr, data), rle)) in enumerate(zip(chunks, packed)):
+        shm.buf[offset:offset + len(data)] = data
+        shm.buf[offset + len(data):offset + len(data) + len(rle)] = rle
+        TABLE_ENTRY.pack_into(shm.buf, TABLE_HEADER.size + TABLE_ENTRY.size * i,
+            addr, offset, len(data), zlib.crc32(data) & 0xFFFFFFFF,
+            offset + len(data), len(rle))
+        offset += len(data) + len(rle)
+    name = shm.name
+    shm.close()
+    return (job, name)
+
+class PreparedImage(object):
+    def __init__(self, job, name):
+        """
+        A prepared job whose chunks live in shared memory. It stands in for a
+        FlashImage whose transfers have already been planned, with packed
+        holding the compressed form of chunks by address and length.
+        """
+        self.job = job
+        self.planned = True
+        self.__shm = shared_memory.SharedMemory(name=name)
+        buf = self.__shm.buf
+        (count,) = TABLE_HEADER.unpack_from(buf)
+        table = [TABLE_ENTRY.unpack_from(buf, TABLE_HEADER.size +
+            TABLE_ENTRY.size * i) for i in range(count)]
+        self.chunks = [(addr, buf[offset:offset + length]) for \
+            (addr, offset, length, crc, poff, plen) in table]
+        self.crcs = [crc for (addr, offset, length, crc, poff, plen) in table]
+        self.packed = dict(((addr, length), buf[poff:poff + plen]) for \
+            (addr, offset, length, crc, poff, plen) in table if plen)
+
+    def __str__(self):
+        return "<PreparedImage {0} chunks={1}>".format(self.job.name,
+            len(self.chunks))
+
+    def release(self):
+        """
+        Frees the shared memory once the image has been programmed
+        """
+        for (addr, data) in self.chunks:
+            data.release()
+        for data in self.packed.values():
+            data.release()
+        self.chunks = []
+        self.packed = {}
+        self.__shm.close()
+        self.__shm.unlink()
+
+class JobPipeline(object):
+    def __init__(self, jobs, workers=None, depth=4):
+        """
+        Prepares jobs over a pool of processes
+        jobs: Iterable of Job, consumed lazily so it may be a stream
+        workers: Number of processes, defaulting to the number of CPUs
+        depth: Number of prepared images which may wait for the SWD side
+        """
+        self.__jobs = iter(jobs)
+        # workers share our tracker, so blocks they create may be freed here
+        resource_tracker.ensure_running()
+        self.__pool = ProcessPoolExecutor(workers)
+        self.__queue = queue.Queue(depth)
+        self.__inflight = depth + (workers or 1)
+        self.__closed = False
+        self.__feeder = threading.Thread(target=self.__feed, daemon=True)
+        self.__feeder.start()
+
+    def __put(self, item):
+        if not self.__closed:
+            self.__queue.put(item)
+        elif isinstance(item, PreparedImage):
+            item.release()
+        if self.__closed:
+            self.__drain()
+
+    def __drain(self):
+        """
+        Frees any prepared images which will not be programmed
+        """
+        while True:
+            try:
+                item = self.__queue.get_nowait()
+            except queue.Empty:
+                return
+            if isinstance(item, PreparedImage):
+                item.release()
+
+    @staticmethod
+    def __discard(futures):
+        """
+        Frees the blocks of jobs which were prepared but will not be handed out
+        """
+        for future in futures:
+            try:
+                (job, name) = future.result()
+            except Exception:
+                # cancelled or failed, so no block was left behind
+                continue
+            block = shared_memory.SharedMemory(name=name)
+            block.close()
+            block.unlink()
+
+    def __feed(self):
+        """
+        Keeps the pool busy while preserving job order. Putting to the bounded
+        queue blocks, which stops preparation running away from the link.
+        """
+        pending = []
+        try:
+            for job in self.__jobs:
+                if self.__closed:
+                    break
+                pending.append(self.__pool.submit(prepare_job, job))
+                if len(pending) >= self.__inflight:
+                    self.__put(PreparedImage(*pending.pop(0).result()))
+            while pending and not self.__closed:
+                self.__put(PreparedImage(*pending.pop(0).result()))
+            self.__put(None)
+        except Exception as e:
+            self.__put(e)
+        finally:
+            self.__discard(pending)
+
+    def get(self):
+        """
+        Returns the next prepared image, or None once all jobs are done. Safe
+        to call from several SWD worker threads.
+        """
+        item = self.__queue.get()
+        if item is None or isinstance(item, Exception):
+            # let any other workers see the end as well
+            self.__queue.put(item)
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def __iter__(self):
+        while True:
+            image = self.get()
+            if image is None:
+                return
+            yield image
+
+    def close(self):
+        """
+        Stops preparing jobs and frees the images nobody has taken
+        """
+        self.__closed = True
+        self.__drain()
+        self.__pool.shutdown(cancel_futures=True)
+        # the feeder frees whatever was still being prepared, unless it is
+        # waiting on the job stream
+        self.__feeder.join(1.0)
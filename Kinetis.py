@@ -20,16 +20,15 @@ class MDM_AP(object):
 
     def control(self, flash_erase=False, debug_disable=False, debug_request=False,
         reset_request=False, core_hold=False):
-        val = 1 << 0 if flash_erase else 0 |\
-            1 << 1 if debug_disable else 0 |\
-            1 << 2 if debug_request else 0 |\
-            1 << 3 if reset_request else 0 |\
-            1 << 4 if core_hold else 0
+        val = (1 << 0 if flash_erase else 0) |\
+            (1 << 1 if debug_disable else 0) |\
+            (1 << 2 if debug_request else 0) |\
+            (1 << 3 if reset_request else 0) |\
+            (1 << 4 if core_hold else 0)
         self.dp.writeAP(self.apsel, 0x04, val)
-        return self.dp.readRB()
 
     def get_control(self):
-        self.db.readAP(self.apsel)
+        self.dp.readAP(self.apsel, 0x04)
         return self.dp.readRB()
 
 class Kinetis(object):
@@ -42,10 +41,26 @@ class Kinetis(object):
     AIRCR = 0xE000ED0C # Application interrupt and reset control register
     VTOR  = 0xE000ED08 # Vector table offset register
 
+    S_RESET_ST = 0x02000000 # DHCSR: core reset since DHCSR was last read
+    S_HALT     = 0x00020000 # DHCSR: core is halted
+    S_REGRDY   = 0x00010000 # DHCSR: core register transfer complete
+
+    MDM_FLASH_READY  = 0x2 # MDM-AP status
+    MDM_SYSTEM_RESET = 0x8 # MDM-AP status: clear while the system is in reset
 
-    def __init__(self, debugPort):
+    def __init__(self, debugPort, timeout=0.5, erase_timeout=5.0):
+        """
+        Initializes the device
+        timeout: Seconds which each reset, halt or wait sequence may take
+        erase_timeout: Seconds which a mass erase may take
+        """
+        self.dp = debugPort
+        self.timeout = timeout
+        self.erase_timeout = erase_timeout
         self.ahb = MEM_AP(debugPort, 0) # MEM-AP is located at access port 0
         self.mdm = MDM_AP(debugPort, 1) # MDM-AP is located at access port 1
+        # values read from the board which hold until the next reconnect
+        self.session = {}
 
     def __str__(self):
         """
@@ -56,17 +71,46 @@ class Kinetis(object):
         lst.append("MDM-AP: 0x{0:x}".format(self.mdm.idcode()))
         return '\n'.join(lst)
 
-    def wait_flash(self):
+    def __poll(self, read, done, deadline, what, recover=False):
+        """
+        Reads back to back until done(value) holds, raising SWDTimeoutError
+        once the deadline has passed. With recover, a link which drops while
+        the target resets is re-established.
+
+        Returns the last value read
+        """
+        while True:
+            try:
+                value = read()
+                if done(value):
+                    return value
+            except (SWDFaultError, SWDWaitError, SWDProtocolError):
+                if not recover:
+                    raise
+                self.reconnect()
+            if time.perf_counter() > deadline:
+                raise SWDTimeoutError("Timed out waiting for " + what)
+
+    def reconnect(self):
+        """
+        Re-establishes the link after a reset or on a new board of the same
+        kind without a full init
+        """
+        self.dp.reconnect()
+        self.ahb.invalidate()
+        self.session.clear()
+
+    def wait_flash(self, deadline=None):
         """
         Waits until the device flash is ready
 
         Returns the current device status
         """
-        while True:
-            status = self.mdm.status()
-            if status & 0x2:
-                return status
-            time.sleep(0.1)
+        if deadline is None:
+            deadline = time.perf_counter() + self.timeout
+        return self.__poll(self.mdm.status,
+            lambda status: status & Kinetis.MDM_FLASH_READY, deadline,
+            "the flash to become ready")
 
     def is_secured(self):
         """
@@ -81,12 +125,13 @@ class Kinetis(object):
         Returns whether or not the device is still secured
         """
         if self.is_secured():
+            deadline = time.perf_counter() + self.erase_timeout
             self.mdm.control(flash_erase=True)
-            while True:
-                status = self.wait_flash()
-                if not status & 0x1:
-                    return self.is_secured()
-                time.sleep(0.1)
+            # the erase bit clears itself once the erase has completed
+            self.__poll(self.mdm.get_control, lambda control: \
+                not control & 0x1, deadline, "the mass erase")
+            self.wait_flash()
+            return self.is_secured()
 
     def registers(self, reg=None, value=None, output_hex=True):
         """
@@ -119,23 +164,52 @@ class Kinetis(object):
 
     def halt(self, reset=False):
         """
-        Places the device in halt
+        Places the device in halt, resetting it first if requested
+
+        Returns DHCSR once the core has halted
 
         ARMv6
         """
+        if reset:
+            return self.reset()
+        deadline = time.perf_counter() + self.timeout
         self.ahb.writeWord(Kinetis.DHCSR, 0xA05F0003)
+        return self.__poll(lambda: self.ahb.readWord(Kinetis.DHCSR),
+            lambda dhcsr: dhcsr & Kinetis.S_HALT, deadline, "the core to halt")
 
-    def reset(self):
+    def reset(self, halt=True):
         """
-        Resets the device, activating halt once the reset completes
+        Resets the device through the MDM-AP. To halt, the core is held in
+        reset while the rest of the system comes out of it, and once released
+        it stops on the reset vector through the reset vector catch before
+        running a single instruction. The whole sequence shares one deadline.
+
+        Returns DHCSR once the core has halted, or None if it was left running
 
         MDM-AP
         """
-        self.ahb.writeWord(Kinetis.DEMCR, 0x1) #enable core catch
-        self.ahb.readWord(Kinetis.DHCSR) # clear reset flag
-        self.ahb.writeWord(Kinetis.AIRCR, 0x05FA0004) # request reset
-        while not (self.ahb.readWord(Kinetis.DHCSR & 0x02000000)): # wait
-            time.sleep(0.1)
+        deadline = time.perf_counter() + self.timeout
+        if halt:
+            self.ahb.writeWord(Kinetis.DHCSR, 0xA05F0001) # debug enable
+            self.ahb.writeWord(Kinetis.DEMCR, 0x1) # enable core catch
+        else:
+            self.ahb.writeWord(Kinetis.DEMCR, 0x0)
+            self.ahb.writeWord(Kinetis.DHCSR, 0xA05F0000)
+        self.mdm.control(reset_request=True, core_hold=halt)
+        self.mdm.control(core_hold=halt)
+        self.__poll(self.mdm.status,
+            lambda status: status & Kinetis.MDM_SYSTEM_RESET, deadline,
+            "the system to leave reset", recover=True)
+        if not halt:
+            return None
+        self.mdm.control() # release the core
+        # S_RESET_ST is sticky until read, so it may show before the halt
+        seen = [0]
+        def halted(dhcsr):
+            seen[0] |= dhcsr
+            return seen[0] & Kinetis.S_RESET_ST and dhcsr & Kinetis.S_HALT
+        return self.__poll(lambda: self.ahb.readWord(Kinetis.DHCSR), halted,
+            deadline, "the core to halt after reset", recover=True)
 
     def run(self):
         """
@@ -151,17 +225,20 @@ class Kinetis(object):
 
     # Kinetis stuff
 
+    def __wait_register(self):
+        self.__poll(lambda: self.ahb.readWord(Kinetis.DHCSR),
+            lambda dhcsr: dhcsr & Kinetis.S_REGRDY,
+            time.perf_counter() + self.timeout, "a core register transfer")
+
     def get_r(self, r):
         self.ahb.writeWord(Kinetis.DCRSR, r & 0x1F)
-        while not (self.ahb.readWord(Kinetis.DHCSR) & 0x10000):
-            time.sleep(0.1)
+        self.__wait_register()
         return self.ahb.readWord(Kinetis.DCRDR)
 
     def set_r(self, r, val):
         self.ahb.writeWord(Kinetis.DCRDR, val)
         self.ahb.writeWord(Kinetis.DCRSR, 0x10000 | (r & 0x1F))
-        while not (self.ahb.readWord(Kinetis.DHCSR) & 0x10000):
-            time.sleep(0.1)
+        self.__wait_register()
 
     def vtor(self, addr=None):
         if addr is not None:
@@ -170,18 +247,21 @@ class Kinetis(object):
             v = self.ahb.readWord(Kinetis.VTOR)
             return v
 
+    def read_into(self, addr, buf):
+        """
+        Reads memory into a caller-supplied bytearray, array or memoryview
+        without allocating per word
+
+        Returns the number of bytes read
+        """
+        return self.ahb.readInto(addr, buf)
+
     # writes data to an address
     def write_to_ram(self, addr, data):
         """
         Writes a stream of 8-bit values to RAM
-        """
-        if any([d > 0xFF for d in data]):
-            raise InvalidDataException("Data contains values greater than 0xFF")
-        # pad array with zeros to be divisible by 4
-        if len(data) % 4:
-            data[len(data):] = [0] * (4 - (len(data) % 4))
 
-        # convert to 32-bit values for speed
-        a_data = [(data[i+3] << 24) + (data[i+2] << 16) + (data[i+1] << 8) + \
-            data[i] for i in range(0, len(data), 4)]
-        self.ahb.writeBlock(addr, a_data)
+        This streams the block at line rate relying on overrun detection, so
+        the caller should verify the written region afterwards.
+        """
+        self.ahb.writeMem(addr, bytes(data))
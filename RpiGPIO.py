@@ -34,6 +34,7 @@ class Adapter:
         self.SWDCK = 18
         self.debug = False
         self.debugFull = False
+        self.setClockRate(None)
         GPIO.setup(self.SWDIO, GPIO.OUT)
         GPIO.output(self.SWDIO, GPIO.LOW)
         GPIO.setup(self.SWDCK, GPIO.OUT)
@@ -55,9 +56,20 @@ class Adapter:
     def clear (self, more = 0):
             print("DEBUG : clear")
 
+    def setClockRate (self, rate):
+        """
+        Sets the SWD clock rate in Hz. None runs the clock as fast as the GPIO
+        can be toggled.
+        """
+        self.clockRate = rate
+        self.halfPeriod = 0 if rate is None else 0.5 / rate
+
     def short_sleep(self):
-        #time.sleep(0.0001)
-        i=0
+        # time.sleep is far too coarse for half a clock period
+        if self.halfPeriod:
+            end = time.perf_counter() + self.halfPeriod
+            while time.perf_counter() < end:
+                pass
 
     def readBits (self, count):
         GPIO.setup(self.SWDIO, GPIO.IN)
@@ -122,6 +134,11 @@ class Adapter:
         self.sendBytes([0xFF] * 8)
         self.sendBytes([0x00] * 8)
 
+    def lineReset (self):
+        """ Line reset followed by the mandatory IDCODE read """
+        self.resyncSWD()
+        return self.readSWD(False, 0)
+
     def readSWD (self, ap, register):
         if self.debug:
            print("DEBUG - readSWD %s " % [calcOpcode(ap, register, True)])
@@ -12,6 +12,7 @@ class SWDAdapterBase(object):
 
     def __init__(self):
         self.log = logging.getLogger("comm")
+        self.clockRate = None
 
     #
     # Mandatory interface - these must be implemented by hardware
@@ -106,6 +107,15 @@ class SWDAdapterBase(object):
         else:
             raise SWDProtocolError(ack)
 
+    def setClockRate(self, rate):
+        "Set the SWD clock rate in Hz, None for the fastest the hardware can do"
+        self.clockRate = rate
+
+    def lineReset(self):
+        "Line reset followed by the mandatory IDCODE read"
+        self.resetSWD()
+        return self.readCmd(OP_DP, 0)
+
     def resetSWD(self):
         # "It consists of a sequence of 50 clock cycles with data = 1"
         # We send 64 bits
@@ -0,0 +1,157 @@
+"""
+Adaptive SWD clock rate tuning
+
+Wraps an adapter which supports setClockRate and steps the clock down when
+parity errors, protocol errors or WAIT responses become frequent and back up
+again once the link has been clean for a while. WAITs are retried, and so are
+DP transactions which failed, after a line reset. The rate which was finally
+used is recorded per fixture so that the next run on the same station starts
+from there.
+"""
+
+import json
+import os
+from SWDErrors import *
+
+CLOCK_RATES = (4000000, 2000000, 1000000, 500000, 250000, 100000, 50000)
+
+DEFAULT_STORE = os.path.expanduser('~/.swd-kinetis/fixtures.json')
+
+class ClockTuner(object):
+    def __init__(self, swd, fixture, store=DEFAULT_STORE, window=256,
+        max_error_rate=0.01, max_wait_rate=0.25, promote_after=4, retries=3):
+        """
+        Initializes the tuner
+        swd: The adapter to wrap
+        fixture: The name under which the chosen rate is recorded
+        store: Path of the json file holding the rate of each fixture
+        window: Number of transactions over which error rates are measured
+        max_error_rate: Fraction of transactions which may fail before the
+            clock is slowed down
+        max_wait_rate: Fraction of transactions which may be answered with WAIT
+            before the clock is slowed down
+        promote_after: Number of clean windows before the clock is sped up
+        retries: Number of times a transaction is retried at one rate
+        """
+        self.swd = swd
+        self.fixture = fixture
+        self.store = store
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.max_wait_rate = max_wait_rate
+        self.promote_after = promote_after
+        self.retries = retries
+        self.__transactions = 0
+        self.__errors = 0
+        self.__waits = 0
+        self.__clean_windows = 0
+        self.__index = 0
+        # number of times each rate has been stepped down from
+        self.__demotions = [0] * len(CLOCK_RATES)
+        rate = self.__load().get(self.fixture)
+        if rate in CLOCK_RATES:
+            self.__index = CLOCK_RATES.index(rate)
+        self.swd.setClockRate(self.rate())
+
+    def __getattr__(self, name):
+        return getattr(self.swd, name)
+
+    def rate(self):
+        """
+        Returns the current clock rate in Hz
+        """
+        return CLOCK_RATES[self.__index]
+
+    def __load(self):
+        try:
+            with open(self.store) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save(self):
+        """
+        Records the current rate for this fixture
+        """
+        rates = self.__load()
+        rates[self.fixture] = self.rate()
+        directory = os.path.dirname(self.store)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.store, 'w') as f:
+            json.dump(rates, f, indent=4, sort_keys=True)
+
+    def __step(self, delta):
+        index = min(max(self.__index + delta, 0), len(CLOCK_RATES) - 1)
+        if index == self.__index:
+            return False
+        if delta > 0:
+            self.__demotions[self.__index] += 1
+        self.__index = index
+        self.swd.setClockRate(self.rate())
+        self.__transactions = 0
+        self.__errors = 0
+        self.__waits = 0
+        self.__clean_windows = 0
+        print("SWD clock now {0} Hz".format(self.rate()))
+        return True
+
+    def __account(self):
+        self.__transactions += 1
+        if self.__transactions < self.window:
+            return
+        if self.__errors > self.window * self.max_error_rate or \
+            self.__waits > self.window * self.max_wait_rate:
+            self.__step(1)
+            return
+        if self.__errors == 0:
+            self.__clean_windows += 1
+        else:
+            self.__clean_windows = 0
+        self.__transactions = 0
+        self.__errors = 0
+        self.__waits = 0
+        # back off exponentially from rates which have already failed
+        if self.__index > 0 and self.__clean_windows >= self.promote_after * \
+            2 ** self.__demotions[self.__index - 1]:
+            self.__step(-1)
+
+    def __recover(self):
+        """
+        Line reset after a failed transaction. Sticky errors are left for the
+        caller to check and clear, since a repeated CTRL/STAT read must still
+        report an overrun which happened before it.
+        """
+        self.swd.lineReset()
+
+    def __transact(self, fn, repeatable):
+        """
+        Performs a transaction, retrying it where that is safe. A WAIT means
+        the target did not accept it. After a corrupted ACK or data the
+        transaction may or may not have taken place, so it is only repeated
+        when repeatable, as DP accesses are. An AP access may have moved the
+        TAR on or posted a read, so the error is raised for the caller.
+        """
+        while True:
+            for attempt in range(self.retries):
+                try:
+                    result = fn()
+                    self.__account()
+                    return result
+                except SWDWaitError:
+                    self.__waits += 1
+                except (SWDProtocolError, SWDParityError):
+                    self.__errors += 1
+                    self.__recover()
+                    if not repeatable:
+                        raise
+            if not self.__step(1):
+                raise SWDProtocolError("Transaction failed at {0} Hz".format(
+                    self.rate()))
+
+    def readSWD(self, ap, register):
+        return self.__transact(lambda: self.swd.readSWD(ap, register), not ap)
+
+    def writeSWD(self, ap, register, data, ignoreACK=False):
+        return self.__transact(
+            lambda: self.swd.writeSWD(ap, register, data, ignoreACK), not ap)
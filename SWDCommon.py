@@ -1,5 +1,8 @@
 import sys
 import time
+import struct
+from array import array
+from SWDErrors import *
 
 class DebugPort:
     ID_CODES = (
@@ -10,6 +13,9 @@ class DebugPort:
         )
     def __init__ (self, swd):
         self.swd = swd
+        self.orunDetect = False
+        self.transactions = {}
+        self.phase('init')
 
     def init(self):
         # read the IDCODE
@@ -19,7 +25,7 @@ class DebugPort:
         if idcode not in DebugPort.ID_CODES:
             print("warning: unexpected idcode: ", idcode)
         # power shit up
-        self.swd.writeSWD(False, 1, 0x54000000)
+        self.writeSWD(False, 1, 0x54000000)
         if (self.status() >> 24) != 0xF4:
             print("error powering up system")
             sys.exit(1)
@@ -28,8 +34,45 @@ class DebugPort:
         self.curAP = 0
         self.curBank = 0
 
+    def reconnect (self):
+        """
+        Re-establishes the link after a target reset or with a new target of
+        the same kind, using a line reset instead of a full init. The debug
+        domain is only powered up again if it lost power.
+        """
+        self.transactions[self.curPhase] += 1
+        idcode = self.swd.lineReset()
+        if idcode not in DebugPort.ID_CODES:
+            print("warning: unexpected idcode: ", idcode)
+        self.abort(True, True, True, True, False)
+        if (self.status() >> 24) != 0xF4:
+            self.writeSWD(False, 1, 0x54000000)
+            self.orunDetect = False
+            if (self.status() >> 24) != 0xF4:
+                print("error powering up system")
+                sys.exit(1)
+        # a new target starts with SELECT cleared
+        self.select(0,0)
+        self.curAP = 0
+        self.curBank = 0
+
+    def phase (self, name):
+        """ Accounts the following transactions against the named phase """
+        self.curPhase = name
+        self.transactions.setdefault(name, 0)
+        if hasattr(self.swd, 'mark'):
+            self.swd.mark(name)
+
+    def readSWD (self, ap, register):
+        self.transactions[self.curPhase] += 1
+        return self.swd.readSWD(ap, register)
+
+    def writeSWD (self, ap, register, data, ignore = False):
+        self.transactions[self.curPhase] += 1
+        self.swd.writeSWD(ap, register, data, ignore)
+
     def idcode (self):
-        return self.swd.readSWD(False, 0)
+        return self.readSWD(False, 0)
 
     def abort (self, orunerr, wdataerr, stickyerr, stickycmp, dap, debug=False):
         if debug:
@@ -42,10 +85,10 @@ class DebugPort:
         value = value | (0x04 if stickyerr else 0x00)
         value = value | (0x02 if stickycmp else 0x00)
         value = value | (0x01 if dap else 0x00)
-        self.swd.writeSWD(False, 0, value)
+        self.writeSWD(False, 0, value)
 
     def status (self):
-        return self.swd.readSWD(False, 1)
+        return self.readSWD(False, 1)
 
     def control (self, trnCount = 0, trnMode = 0, maskLane = 0, orunDetect = 0):
         value = 0x54000000
@@ -53,16 +96,41 @@ class DebugPort:
         value = value | ((maskLane & 0x00F) << 8)
         value = value | ((trnMode  & 0x003) << 2)
         value = value | (0x1 if orunDetect else 0x0)
-        self.swd.writeSWD(False, 1, value)
+        self.writeSWD(False, 1, value)
+
+    def overrunDetect (self, enable):
+        """
+        Enables or disables overrun detection. While enabled, every transaction
+        has a data phase regardless of its ACK, so ACKs may be ignored and
+        checked once through STICKYORUN instead.
+        """
+        self.control(orunDetect = enable)
+        self.orunDetect = enable
+
+    def overrun (self):
+        """
+        Checks and clears STICKYORUN. A FAULT or write data error among the
+        transactions whose ACKs were ignored raises SWDFaultError instead,
+        since those writes did not land and cannot be replayed.
+        """
+        status = self.status()
+        if status & 0xA0:
+            self.abort(True, True, True, False, False)
+            raise SWDFaultError("Fault while ignoring ACKs, DP status " + \
+                "{0:x}".format(status))
+        if not status & 0x2:
+            return False
+        self.abort(True, False, False, False, False)
+        return True
 
     def select (self, apsel, apbank):
         value = 0x00000000
         value = value | ((apsel  & 0xFF) << 24)
         value = value | ((apbank & 0x0F) <<  4)
-        self.swd.writeSWD(False, 2, value)
+        self.writeSWD(False, 2, value)
 
     def readRB (self):
-        return self.swd.readSWD(False, 3)
+        return self.readSWD(False, 3)
 
     def readAP (self, apsel, address):
         adrBank = (address >> 4) & 0xF
@@ -71,7 +139,22 @@ class DebugPort:
             self.select(apsel, adrBank)
             self.curAP = apsel
             self.curBank = adrBank
-        return self.swd.readSWD(True, adrReg)
+        return self.readSWD(True, adrReg)
+
+    def readAPInto (self, apsel, address, words, off = 0, count = None):
+        """
+        Performs count reads of an AP register into a writable sequence of
+        words starting at off. AP reads are posted, so the first result is
+        discarded and the last is collected from RDBUFF.
+        """
+        if count is None:
+            count = len(words) - off
+        if not count:
+            return
+        self.readAP(apsel, address)
+        for i in range(off, off + count - 1):
+            words[i] = self.readAP(apsel, address)
+        words[off + count - 1] = self.readRB()
 
     def writeAP (self, apsel, address, data, ignore = False):
         adrBank = (address >> 4) & 0xF
@@ -80,19 +163,47 @@ class DebugPort:
             self.select(apsel, adrBank)
             self.curAP = apsel
             self.curBank = adrBank
-        self.swd.writeSWD(True, adrReg, data, ignore)
+        self.writeSWD(True, adrReg, data, ignore)
 
 class MEM_AP:
+    TAR_WRAP = 0x400 # TAR auto-increment is only guaranteed within 1KB
+    SIZES = { 1: 0, 2: 1, 4: 2 } # access size in bytes to CSW.Size
+    STREAM_REPLAYS = 16 # replays of one TAR run before giving up
+
     def __init__ (self, dp, apsel):
         self.dp = dp
         self.apsel = apsel
+        self.packed = None
+        self.invalidate()
+
+    def invalidate (self):
+        """
+        Forget the CSW shadow, e.g. after the target has been reset, and set
+        CSW again since the read paths rely on it auto-incrementing
+        """
+        self.cswBase = None
+        self.cswValue = None
         self.csw(1,2) # 32-bit auto-incrementing addressing
 
     def csw (self, addrInc, size):
-        """ Set control/status word register """
-        self.dp.readAP(self.apsel, 0x00)
-        csw = self.dp.readRB() & 0xFFFFFF00
-        self.dp.writeAP(self.apsel, 0x00, csw + (addrInc << 4) + size)
+        """ Set control/status word register, skipping redundant writes """
+        if self.cswBase is None:
+            self.dp.readAP(self.apsel, 0x00)
+            self.cswBase = self.dp.readRB() & 0xFFFFFF00
+        value = self.cswBase + (addrInc << 4) + size
+        if value != self.cswValue:
+            self.dp.writeAP(self.apsel, 0x00, value)
+            self.cswValue = value
+
+    def supportsPacked (self):
+        """ Determines if the AP implements packed transfers """
+        if self.packed is None:
+            self.csw(2, 1) # 16-bit packed-incrementing addressing
+            self.dp.readAP(self.apsel, 0x00)
+            self.packed = ((self.dp.readRB() >> 4) & 0x3) == 2
+            self.cswValue = None # AddrInc reads back differently if not
+            self.csw(1, 2)
+        return self.packed
 
     def status (self):
         self.dp.readAP(self.apsel, 0x00)
@@ -116,11 +227,54 @@ class MEM_AP:
         self.dp.writeAP(self.apsel, 0x0C, data)
         return self.dp.readRB()
 
-    def readBlock (self, adr, count):
-        self.dp.writeAP(self.apsel, 0x04, adr)
-        vals = [self.dp.readAP(self.apsel, 0x0C) for off in range(count)]
-        vals.append(self.dp.readRB())
-        return vals[1:]
+    def tarRuns (self, adr, count, size = 4):
+        """
+        Splits count transfers of size bytes starting at adr into runs which do
+        not cross a TAR auto-increment boundary. Yields tuples of (address,
+        offset, length)
+        """
+        off = 0
+        while off < count:
+            room = (MEM_AP.TAR_WRAP - (adr & (MEM_AP.TAR_WRAP - 1))) // size
+            n = min(count - off, room)
+            yield (adr, off, n)
+            adr += n * size
+            off += n
+
+    def readBlock (self, adr, count, size = 4):
+        vals = [0] * count
+        self.readBlockInto(adr, vals, size)
+        return vals
+
+    def readBlockInto (self, adr, words, size = 4):
+        """
+        Read len(words) transfers into a writable sequence of words, such as a
+        list, array('I') or a memoryview cast to 'I'
+        """
+        for (start, off, n) in self.tarRuns(adr, len(words), size):
+            self.dp.writeAP(self.apsel, 0x04, start)
+            self.dp.readAPInto(self.apsel, 0x0C, words, off, n)
+
+    def readInto (self, adr, buf, size = 4):
+        """
+        Read into a caller-supplied writable buffer, such as a bytearray,
+        array('I') or memoryview, starting at any address using accesses no
+        wider than size. Words are stored straight into the buffer and byte
+        swapped in bulk only on big-endian hosts.
+        """
+        view = memoryview(buf).cast('B')
+        for (start, off, width, count) in self.spans(adr, len(view), size):
+            if width != 4:
+                view[off:off + width * count] = self.readSized(start, width,
+                    count)
+                continue
+            chunk = view[off:off + 4 * count]
+            self.readBlockInto(start, chunk.cast('I'))
+            if sys.byteorder == 'big':
+                words = array('I', chunk.tobytes())
+                words.byteswap()
+                chunk[:] = words.tobytes()
+        return len(view)
 
     def writeBlock (self, adr, data):
         self.dp.writeAP(self.apsel, 0x04, adr)
@@ -128,6 +282,49 @@ class MEM_AP:
             time.sleep(0.01)
             self.dp.writeAP(self.apsel, 0x0C, val)
 
+    def writeBlockFast (self, adr, data):
+        """
+        Write words back to back, re-issuing TAR only at auto-increment
+        boundaries. The caller is expected to verify the result as a whole.
+        """
+        for (start, off, n) in self.tarRuns(adr, len(data)):
+            self.dp.writeAP(self.apsel, 0x04, start)
+            for val in data[off:off+n]:
+                self.dp.writeAP(self.apsel, 0x0C, val)
+
+    def writeBlockStream (self, adr, data, size = 4):
+        """
+        Write words at line rate without checking each ACK. Overrun detection
+        is checked once after each TAR run. On overrun the TAR is read back to
+        find the first word which did not land and the run is replayed from
+        there, up to STREAM_REPLAYS times. A FAULT raises SWDFaultError.
+        """
+        self.dp.overrunDetect(True)
+        try:
+            for (start, off, n) in self.tarRuns(adr, len(data), size):
+                done = 0
+                replays = 0
+                while done < n:
+                    if replays > MEM_AP.STREAM_REPLAYS:
+                        raise SWDWaitError("Stream write at {0:x} still " \
+                            "overrunning after {1} replays".format(
+                            start + done * size, MEM_AP.STREAM_REPLAYS))
+                    replays += 1
+                    # the TAR must have landed for the replay point to be known
+                    self.dp.writeAP(self.apsel, 0x04, start + done * size,
+                        ignore = True)
+                    if self.dp.overrun():
+                        continue
+                    for val in data[off+done:off+n]:
+                        self.dp.writeAP(self.apsel, 0x0C, val, ignore = True)
+                    if not self.dp.overrun():
+                        break
+                    # TAR was incremented once for every write which completed
+                    done += ((self.tar() - start - done * size) & \
+                        (MEM_AP.TAR_WRAP - 1)) // size
+        finally:
+            self.dp.overrunDetect(False)
+
     def writeBlockNonInc (self, adr, data):
         self.csw(0, 2) # 32-bit non-incrementing addressing
         self.dp.writeAP(self.apsel, 0x04, adr)
@@ -137,9 +334,97 @@ class MEM_AP:
 
     def writeHalfs (self, adr, data):
         """ Write half-words """
-        self.csw(2, 1) # 16-bit packed-incrementing addressing
-        self.dp.writeAP(self.apsel, 0x04, adr)
-        for val in data:
-            time.sleep(0.001)
-            self.dp.writeAP(self.apsel, 0x0C, val, ignore = True)
-        self.csw(1, 2) # 32-bit auto-incrementing addressing
+        self.writeSized(adr, 2, struct.pack('<%dH' % len(data), *data))
+
+    def readSized (self, adr, size, count):
+        """
+        Read count elements of size bytes starting at adr, which must be
+        aligned to size. Packed transfers are used where the AP supports them.
+        Returns the little-endian bytes read.
+        """
+        out = bytearray()
+        code = MEM_AP.SIZES[size]
+        per = 4 // size
+        if size < 4 and adr % 4 == 0 and count >= per and self.supportsPacked():
+            words = count // per
+            self.csw(2, code) # packed-incrementing addressing
+            out += struct.pack('<%dI' % words, *self.readBlock(adr, words))
+            adr += words * 4
+            count -= words * per
+        if count:
+            self.csw(1, code) # single-incrementing addressing
+            vals = self.readBlock(adr, count, size)
+            if size == 4:
+                out += struct.pack('<%dI' % count, *vals)
+            else:
+                mask = (1 << (size * 8)) - 1
+                for (i, v) in enumerate(vals):
+                    lane = ((adr + i * size) & 3) * 8
+                    out += ((v >> lane) & mask).to_bytes(size, 'little')
+        self.csw(1, 2)
+        return bytes(out)
+
+    def writeSized (self, adr, size, data):
+        """
+        Write the little-endian bytes in data as elements of size bytes
+        starting at adr, which must be aligned to size. Packed transfers are
+        used where the AP supports them.
+        """
+        view = memoryview(data).cast('B')
+        code = MEM_AP.SIZES[size]
+        per = 4 // size
+        count = len(view) // size
+        if size < 4 and adr % 4 == 0 and count >= per and self.supportsPacked():
+            words = count // per
+            self.csw(2, code) # packed-incrementing addressing
+            self.writeBlockStream(adr, struct.unpack_from('<%dI' % words, view))
+            adr += words * 4
+            view = view[words * 4:]
+            count -= words * per
+        if count:
+            self.csw(1, code) # single-incrementing addressing
+            if size == 4:
+                vals = struct.unpack_from('<%dI' % count, view)
+            else:
+                # sub-word data travels on the byte lanes of its address
+                vals = [int.from_bytes(view[i*size:(i+1)*size], 'little') << \
+                    (((adr + i * size) & 3) * 8) for i in range(count)]
+            self.writeBlockStream(adr, vals, size)
+        self.csw(1, 2)
+
+    def spans (self, adr, length, size = 4):
+        """
+        Splits length bytes starting at adr into naturally aligned runs of
+        accesses no wider than size, so that unaligned heads and tails are
+        handled with narrower accesses. Yields tuples of (address, offset,
+        size, count)
+        """
+        off = 0
+        end = adr + length
+        while adr < end:
+            width = size
+            while adr % width or end - adr < width:
+                width >>= 1
+            count = (end - adr) // width if width == size else 1
+            yield (adr, off, width, count)
+            adr += width * count
+            off += width * count
+
+    def readMem (self, adr, length, size = 4):
+        """
+        Read length bytes starting at any address using accesses no wider than
+        size. Returns bytes.
+        """
+        out = bytearray()
+        for (start, off, width, count) in self.spans(adr, length, size):
+            out += self.readSized(start, width, count)
+        return bytes(out)
+
+    def writeMem (self, adr, data, size = 4):
+        """
+        Write a bytes-like object starting at any address using accesses no
+        wider than size
+        """
+        view = memoryview(data).cast('B')
+        for (start, off, width, count) in self.spans(adr, len(view), size):
+            self.writeSized(start, width, view[off:off + width * count])
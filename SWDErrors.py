@@ -17,3 +17,6 @@ class SWDNotPresentError(Exception):
     "Target not present or does not respond"
     pass
 
+class SWDTimeoutError(Exception):
+    "The target did not reach the expected state in time"
+    pass
@@ -0,0 +1,283 @@
+"""
+SWD transaction tracing
+
+TraceRecorder wraps an adapter and streams every DP/AP transaction to a
+compact binary trace file. TraceReplayer answers from such a trace in place of
+an adapter so that a session can be re-run offline at host speed, and
+analyse() summarises where transactions and wall time went.
+
+A trace starts with TRACE_MAGIC followed by fixed size records of the
+opcode, ACK, data and the time in microseconds since the previous record.
+Phase markers are followed by their name.
+"""
+
+import struct
+import time
+from SWDErrors import *
+
+TRACE_MAGIC = b'SWDT\x01'
+RECORD = struct.Struct('<BBII')
+
+# opcode bits of a transaction
+OP_AP = 0x01
+OP_REG_SHIFT = 1
+OP_REG_MASK = 0x06
+OP_READ = 0x08
+OP_IGNORE_ACK = 0x10
+# events, whose data is described alongside
+OP_LINE_RESET = 0xF0 # IDCODE read after the reset
+OP_CLOCK_RATE = 0xF1 # rate in Hz, 0 for as fast as possible
+OP_PHASE = 0xF2      # length of the phase name which follows
+
+ACK_ERRORS = [
+    (1, SWDWaitError),
+    (2, SWDFaultError),
+    (3, SWDProtocolError),
+    (4, SWDParityError),
+    (5, SWDNotPresentError),
+]
+
+class TraceMismatchError(Exception):
+    "The session diverged from the trace being replayed"
+    pass
+
+def make_op(ap, register, read, ignoreACK=False):
+    op = OP_AP if ap else 0
+    op |= (register << OP_REG_SHIFT) & OP_REG_MASK
+    op |= OP_READ if read else 0
+    op |= OP_IGNORE_ACK if ignoreACK else 0
+    return op
+
+def describe_op(op):
+    """
+    Returns a short name for an opcode, such as "AP3 R" or "DP2 W"
+    """
+    if op == OP_LINE_RESET:
+        return "line reset"
+    if op == OP_CLOCK_RATE:
+        return "clock rate"
+    return "{0}{1} {2}".format("AP" if op & OP_AP else "DP",
+        (op & OP_REG_MASK) >> OP_REG_SHIFT, "R" if op & OP_READ else "W")
+
+DP_NAMES = {
+    (0, True): "IDCODE",
+    (0, False): "ABORT",
+    (1, True): "CTRL/STAT",
+    (1, False): "CTRL/STAT",
+    (2, False): "SELECT",
+    (3, True): "RDBUFF",
+}
+
+def register_name(op, select):
+    """
+    Names the register accessed by an opcode, given the current SELECT value
+    if known, such as "DP SELECT W" or "AP0 0x0C R"
+    """
+    if op in (OP_LINE_RESET, OP_CLOCK_RATE) or select is None and op & OP_AP:
+        return describe_op(op)
+    register = (op & OP_REG_MASK) >> OP_REG_SHIFT
+    rw = "R" if op & OP_READ else "W"
+    if not op & OP_AP:
+        return "DP {0} {1}".format(DP_NAMES.get((register, bool(op & OP_READ)),
+            register), rw)
+    return "AP{0} 0x{1:02X} {2}".format(select >> 24,
+        (select & 0xF0) | (register << 2), rw)
+
+def read_trace(name):
+    """
+    Streams the records of a trace file
+
+    Returns a sequence of tuples of the opcode, ack code, data, microseconds
+    since the previous record and the phase name for phase markers
+    """
+    with open(name, 'rb') as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise TraceMismatchError("{0} is not a trace file".format(name))
+        while True:
+            raw = f.read(RECORD.size)
+            if len(raw) < RECORD.size:
+                return
+            (op, ack, data, dt) = RECORD.unpack(raw)
+            text = f.read(data).decode('utf-8') if op == OP_PHASE else None
+            yield (op, ack, data, dt, text)
+
+class TraceRecorder(object):
+    def __init__(self, swd, name):
+        """
+        Records every transaction made through swd to the named file
+        """
+        self.swd = swd
+        self.trace = open(name, 'wb')
+        self.trace.write(TRACE_MAGIC)
+        self.__last = time.perf_counter()
+
+    def __getattr__(self, name):
+        return getattr(self.swd, name)
+
+    def __record(self, op, ack, data, text=b''):
+        now = time.perf_counter()
+        dt = min(int((now - self.__last) * 1e6), 0xFFFFFFFF)
+        self.__last = now
+        self.trace.write(RECORD.pack(op, ack, data & 0xFFFFFFFF, dt) + text)
+
+    def __call(self, op, data, fn):
+        try:
+            result = fn()
+        except Exception as e:
+            for (code, error) in ACK_ERRORS:
+                if isinstance(e, error):
+                    self.__record(op, code, data)
+            raise
+        self.__record(op, 0, data if result is None else result)
+        return result
+
+    def readSWD(self, ap, register):
+        return self.__call(make_op(ap, register, True), 0,
+            lambda: self.swd.readSWD(ap, register))
+
+    def writeSWD(self, ap, register, data, ignoreACK=False):
+        return self.__call(make_op(ap, register, False, ignoreACK), data,
+            lambda: self.swd.writeSWD(ap, register, data, ignoreACK))
+
+    def lineReset(self):
+        return self.__call(OP_LINE_RESET, 0, self.swd.lineReset)
+
+    def setClockRate(self, rate):
+        self.__record(OP_CLOCK_RATE, 0, rate or 0)
+        self.swd.setClockRate(rate)
+
+    def mark(self, phase):
+        """
+        Marks the start of a phase in the trace
+        """
+        text = phase.encode('utf-8')
+        self.__record(OP_PHASE, 0, len(text), text)
+
+    def close(self):
+        self.trace.close()
+
+class TraceReplayer(object):
+    def __init__(self, name):
+        """
+        Stands in for an adapter, answering from the named trace
+        """
+        self.__records = read_trace(name)
+        self.clockRate = None
+
+    def __next(self, op, data=None):
+        for (rop, ack, rdata, dt, text) in self.__records:
+            if rop in (OP_PHASE, OP_CLOCK_RATE):
+                continue
+            if rop != op or (data is not None and rdata != data):
+                raise TraceMismatchError("Expected {0} {1:x}, trace has {2} "\
+                    "{3:x}".format(describe_op(op), data or 0,
+                    describe_op(rop), rdata))
+            for (code, error) in ACK_ERRORS:
+                if ack == code:
+                    raise error(ack)
+            return rdata
+        raise TraceMismatchError("Trace ended before {0}".format(
+            describe_op(op)))
+
+    def readSWD(self, ap, register):
+        return self.__next(make_op(ap, register, True))
+
+    def writeSWD(self, ap, register, data, ignoreACK=False):
+        self.__next(make_op(ap, register, False, ignoreACK), data)
+
+    def lineReset(self):
+        return self.__next(OP_LINE_RESET)
+
+    def setClockRate(self, rate):
+        self.clockRate = rate
+
+    def mark(self, phase):
+        pass
+
+class TraceSummary(object):
+    def __init__(self):
+        """
+        Transaction counts and wall time of a trace
+        """
+        self.phases = {}     # phase: [transactions, microseconds]
+        self.registers = {}  # register description: [transactions, us]
+        self.errors = {}     # ack code: count
+        self.redundant_select = 0
+        self.redundant_tar = 0
+        self.polled = 0
+
+    def __str__(self):
+        header = "{0:16} {1:>14} {2:>11}"
+        row = "{0:16} {1:14} {2:10.3f}s"
+        lst = [header.format("Phase", "transactions", "time")]
+        for (name, (n, us)) in self.phases.items():
+            lst.append(row.format(name, n, us / 1e6))
+        lst.append(header.format("Register", "transactions", "time"))
+        for (name, (n, us)) in sorted(self.registers.items(),
+            key=lambda r: (-r[1][1], -r[1][0])):
+            lst.append(row.format(name, n, us / 1e6))
+        lst.append("Redundant SELECT writes: {0}".format(self.redundant_select))
+        lst.append("Redundant TAR writes: {0}".format(self.redundant_tar))
+        lst.append("Transactions repeating a poll: {0}".format(self.polled))
+        for (code, error) in ACK_ERRORS:
+            if code in self.errors:
+                lst.append("{0}: {1}".format(error.__name__, self.errors[code]))
+        return '\n'.join(lst)
+
+def analyse(name, poll_period=4):
+    """
+    Summarises a trace file by phase and register, counting redundant SELECT
+    and TAR writes and transactions which only repeat a poll. The trace is
+    streamed, so it may be of any length.
+    """
+    summary = TraceSummary()
+    phase = summary.phases.setdefault('init', [0, 0])
+    select = None
+    tar = None
+    tar_step = 4
+    history = []
+    for (op, ack, data, dt, text) in read_trace(name):
+        if op == OP_PHASE:
+            phase = summary.phases.setdefault(text, [0, 0])
+            continue
+        if op == OP_CLOCK_RATE:
+            continue
+        phase[0] += 1
+        phase[1] += dt
+        reg = summary.registers.setdefault(register_name(op, select), [0, 0])
+        reg[0] += 1
+        reg[1] += dt
+        if ack:
+            summary.errors[ack] = summary.errors.get(ack, 0) + 1
+            continue
+        # follow the MEM-AP state to spot writes which change nothing
+        register = (op & OP_REG_MASK) >> OP_REG_SHIFT
+        if op == make_op(False, 2, False):
+            if data == select:
+                summary.redundant_select += 1
+            select = data
+        elif op & OP_AP and select is not None and select & 0xFF0000F0 == 0:
+            if register == 0 and not op & OP_READ:
+                # packed transfers always move the TAR on by a word
+                addr_inc = (data >> 4) & 0x3
+                tar_step = 0 if addr_inc == 0 else \
+                    4 if addr_inc == 2 else 1 << (data & 0x7)
+            elif register == 1 and not op & OP_READ:
+                if data == tar:
+                    summary.redundant_tar += 1
+                tar = data
+            elif register == 3 and tar is not None:
+                tar = (tar & ~0x3FF) | ((tar + tar_step) & 0x3FF)
+        elif op == OP_LINE_RESET:
+            select = None
+            tar = None
+        # a transaction repeating the one a poll period earlier, with the same
+        # result, did no useful work
+        history.append((op, data))
+        if len(history) > 2 * poll_period:
+            history.pop(0)
+        for p in range(1, poll_period + 1):
+            if len(history) >= 2 * p and history[-p:] == history[-2 * p:-p]:
+                summary.polled += 1
+                break
+    return summary
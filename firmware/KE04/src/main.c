@@ -8,6 +8,7 @@
 #include "MKE04Z4.h"
 
 #define BUFFER_LENGTH 64
+#define SECTOR_SIZE 512
 #define API_STATUS_CMD_SHIFT 0
 #define API_STATUS_CMD_MASK (0x7 << API_STATUS_CMD_SHIFT)
 #define API_STATUS_READY_SHIFT 3
@@ -20,6 +21,8 @@
 #define API_STATUS_ERROR(V) ((V & 0xFF) << API_STATUS_ERROR_SHIFT)
 #define API_STATUS_CMD_ERASE 0
 #define API_STATUS_CMD_PROGRAM 1
+#define API_STATUS_CMD_ERASE_SECTOR 3
+#define API_STATUS_CMD_PROGRAM_COMPRESSED 4
 #define API_STATUS_OK 0
 #define API_STATUS_ERR_FLASH 1
 #define API_STATUS_ERR_NOT_IMPLEMENTED 15
@@ -27,6 +30,7 @@
 #define FCMD_START { FTMRE->FSTAT = FTMRE_FSTAT_CCIF_MASK | FTMRE_FSTAT_ACCERR_MASK | FTMRE_FSTAT_FPVIOL_MASK; }
 #define FCMD_MERASE 0x8
 #define FCMD_PROG   0x6
+#define FCMD_SERASE 0xA
 
 
 typedef struct
@@ -40,6 +44,76 @@ typedef struct
 __attribute__((section (".flash_api_state"), used))
 APIState FlashAPIState;
 
+/**
+ * Written by the programmer once this image has been verified in RAM so that
+ * it can skip uploading it again. Placed after .bss so that it survives the
+ * loader being restarted.
+ */
+__attribute__((section (".loader_stamp"), used))
+volatile uint32_t LoaderStamp[2];
+
+/**
+ * Source of the words to program. Raw blocks are read straight out of the
+ * buffer while compressed blocks are decoded from it as they are programmed.
+ *
+ * Compressed blocks are run length encoded. A control byte with bit 7 set is
+ * followed by one byte which is repeated (control & 0x7F) + 3 times. Otherwise
+ * it is followed by control + 1 literal bytes.
+ */
+static uint8_t compressed;
+static uint32_t word_index;
+static const volatile uint8_t *rle_in;
+static uint8_t rle_count, rle_value, rle_literal;
+
+static void source_init(uint8_t is_compressed)
+{
+    compressed = is_compressed;
+    word_index = 0;
+    rle_in = (const volatile uint8_t *)FlashAPIState.buffer;
+    rle_count = 0;
+}
+
+static uint8_t rle_next_byte(void)
+{
+    const volatile uint8_t *end = (const volatile uint8_t *)(FlashAPIState.buffer + BUFFER_LENGTH);
+    uint8_t c;
+
+    if (!rle_count)
+    {
+        if (rle_in >= end)
+            return 0xFF; //malformed, leave the flash erased
+        c = *rle_in++;
+        if (c & 0x80)
+        {
+            rle_literal = 0;
+            rle_count = (c & 0x7F) + 3;
+            rle_value = rle_in < end ? *rle_in++ : 0xFF;
+        }
+        else
+        {
+            rle_literal = 1;
+            rle_count = c + 1;
+        }
+    }
+    rle_count--;
+    if (!rle_literal)
+        return rle_value;
+    return rle_in < end ? *rle_in++ : 0xFF;
+}
+
+static uint32_t source_next_word(void)
+{
+    uint32_t word;
+
+    if (!compressed)
+        return FlashAPIState.buffer[word_index++];
+    word = rle_next_byte();
+    word |= (uint32_t)rle_next_byte() << 8;
+    word |= (uint32_t)rle_next_byte() << 16;
+    word |= (uint32_t)rle_next_byte() << 24;
+    return word;
+}
+
 /**
  * Sets up the ICS module to FEI at approximately 48MHz with the peripheral
  * clock at 24MHz
@@ -77,7 +151,7 @@ static int32_t ftmre_is_done(void)
 
 static void api_tick(void)
 {
-    typedef enum { API_INIT, API_READY, API_PROGRAM_LOAD, API_PROGRAM_WAIT, API_FINISH, API_ERR } State;
+    typedef enum { API_INIT, API_READY, API_PROGRAM_LOAD, API_PROGRAM_WAIT, API_ERASE_LOAD, API_ERASE_WAIT, API_FINISH, API_ERR } State;
     static State state = API_INIT;
     static uint32_t current_index;
 
@@ -119,11 +193,23 @@ static void api_tick(void)
             case API_STATUS_CMD_PROGRAM:
                 //flash program
                 current_index = 0;
+                source_init(0);
+                state = API_PROGRAM_LOAD;
+                break;
+            case API_STATUS_CMD_PROGRAM_COMPRESSED:
+                //flash program, decompressing the buffer on the fly
+                current_index = 0;
+                source_init(1);
                 state = API_PROGRAM_LOAD;
                 break;
+            case API_STATUS_CMD_ERASE_SECTOR:
+                //erase length sectors starting at address
+                current_index = 0;
+                state = API_ERASE_LOAD;
+                break;
             default:
-            FlashAPIState.status = API_STATUS_READY_MASK | API_STATUS_STATUS(API_STATUS_ERR_NOT_IMPLEMENTED);
-                state = API_ERR;
+                //report the command as not implemented and keep accepting others
+                FlashAPIState.status = API_STATUS_READY_MASK | API_STATUS_STATUS(API_STATUS_ERR_NOT_IMPLEMENTED);
                 break;
             }
         }
@@ -143,7 +229,7 @@ static void api_tick(void)
         }
         else
         {
-            temp = FlashAPIState.address + (current_index & 0xFE) * 4;
+            temp = FlashAPIState.address + current_index * 4;
             //command setup
             FTMRE->FCCOBIX = 0x0;
             FTMRE->FCCOBHI = FCMD_PROG;
@@ -152,14 +238,14 @@ static void api_tick(void)
             FTMRE->FCCOBHI = (temp & 0xFF00) >> 8;
             FTMRE->FCCOBLO = (temp & 0xFF);
             //data setup
-            temp = FlashAPIState.buffer[current_index & 0xFE];
+            temp = source_next_word();
             FTMRE->FCCOBIX = 0x2;
             FTMRE->FCCOBHI = (temp & 0xFF00) >> 8;
             FTMRE->FCCOBLO = (temp & 0xFF);
             FTMRE->FCCOBIX = 0x3;
             FTMRE->FCCOBHI = (temp) >> 24;
             FTMRE->FCCOBLO = (temp & 0xFF0000) >> 16;
-            temp = FlashAPIState.buffer[(current_index & 0xFE) + 1];
+            temp = source_next_word();
             FTMRE->FCCOBIX = 0x4;
             FTMRE->FCCOBHI = (temp & 0xFF00) >> 8;
             FTMRE->FCCOBLO = (temp & 0xFF);
@@ -174,7 +260,7 @@ static void api_tick(void)
     case API_PROGRAM_WAIT:
         //waits for the programming operation to complete
         temp = ftmre_is_done();
-        if (temp < 0)
+        if ((int32_t)temp < 0)
         {
             //a flash error occurred
             FlashAPIState.status = API_STATUS_READY_MASK | API_STATUS_STATUS(API_STATUS_ERR_FLASH) | API_STATUS_ERROR(FTMRE->FSTAT);
@@ -186,10 +272,45 @@ static void api_tick(void)
             state = API_PROGRAM_LOAD;
         }
         break;
+    case API_ERASE_LOAD:
+        //loads the erase command for the current sector
+        //If we have erased all of the sectors, this calls API_FINISH
+        if (current_index >= FlashAPIState.length)
+        {
+            state = API_FINISH;
+        }
+        else
+        {
+            temp = FlashAPIState.address + current_index * SECTOR_SIZE;
+            FTMRE->FCCOBIX = 0x0;
+            FTMRE->FCCOBHI = FCMD_SERASE;
+            FTMRE->FCCOBLO = (temp & 0xFF0000) >> 16;
+            FTMRE->FCCOBIX = 0x1;
+            FTMRE->FCCOBHI = (temp & 0xFF00) >> 8;
+            FTMRE->FCCOBLO = (temp & 0xFF);
+            FCMD_START;
+            state = API_ERASE_WAIT;
+        }
+        break;
+    case API_ERASE_WAIT:
+        //waits for the sector erase to complete
+        temp = ftmre_is_done();
+        if ((int32_t)temp < 0)
+        {
+            //a flash error occurred
+            FlashAPIState.status = API_STATUS_READY_MASK | API_STATUS_STATUS(API_STATUS_ERR_FLASH) | API_STATUS_ERROR(FTMRE->FSTAT);
+            state = API_READY;
+        }
+        else if (temp > 0)
+        {
+            current_index++;
+            state = API_ERASE_LOAD;
+        }
+        break;
     case API_FINISH:
         //waits for the command to finish
         temp = ftmre_is_done();
-        if (temp < 0)
+        if ((int32_t)temp < 0)
         {
             //a flash error occurred
             FlashAPIState.status = API_STATUS_READY_MASK | API_STATUS_STATUS(API_STATUS_ERR_FLASH) | API_STATUS_ERROR(FTMRE->FSTAT);
@@ -8,6 +8,7 @@
 #include "arm_cm0p.h"
 
 #define BUFFER_LENGTH 64
+#define SECTOR_SIZE 1024
 #define API_STATUS_CMD_SHIFT 0
 #define API_STATUS_CMD_MASK (0x7 << API_STATUS_CMD_SHIFT)
 #define API_STATUS_READY_SHIFT 3
@@ -20,10 +21,16 @@
 #define API_STATUS_ERROR(V) ((V & 0xFF) << API_STATUS_ERROR_SHIFT)
 #define API_STATUS_CMD_ERASE 0
 #define API_STATUS_CMD_PROGRAM 1
+#define API_STATUS_CMD_ERASE_SECTOR 3
+#define API_STATUS_CMD_PROGRAM_COMPRESSED 4
 #define API_STATUS_OK 0
 #define API_STATUS_ERR_FLASH 1
 #define API_STATUS_ERR_NOT_IMPLEMENTED 15
 
+#define FCMD_START { FTFA_FSTAT = FTFA_FSTAT_ACCERR_MASK | FTFA_FSTAT_FPVIOL_MASK; FTFA_FSTAT = FTFA_FSTAT_CCIF_MASK; }
+#define FCMD_SERASE 0x09
+#define FCMD_ERSALL 0x44
+#define FCMD_PROG   0x06
 
 typedef struct
 {
@@ -36,9 +43,102 @@ typedef struct
 __attribute__((section (".flash_api_state"), used))
 APIState FlashAPIState;
 
+/**
+ * Written by the programmer once this image has been verified in RAM so that
+ * it can skip uploading it again. Placed after .bss so that it survives the
+ * loader being restarted.
+ */
+__attribute__((section (".loader_stamp"), used))
+volatile uint32_t LoaderStamp[2];
+
+/**
+ * Source of the words to program. Raw blocks are read straight out of the
+ * buffer while compressed blocks are decoded from it as they are programmed.
+ *
+ * Compressed blocks are run length encoded. A control byte with bit 7 set is
+ * followed by one byte which is repeated (control & 0x7F) + 3 times. Otherwise
+ * it is followed by control + 1 literal bytes.
+ */
+static uint8_t compressed;
+static uint32_t word_index;
+static const volatile uint8_t *rle_in;
+static uint8_t rle_count, rle_value, rle_literal;
+
+static void source_init(uint8_t is_compressed)
+{
+    compressed = is_compressed;
+    word_index = 0;
+    rle_in = (const volatile uint8_t *)FlashAPIState.buffer;
+    rle_count = 0;
+}
+
+static uint8_t rle_next_byte(void)
+{
+    const volatile uint8_t *end = (const volatile uint8_t *)(FlashAPIState.buffer + BUFFER_LENGTH);
+    uint8_t c;
+
+    if (!rle_count)
+    {
+        if (rle_in >= end)
+            return 0xFF; //malformed, leave the flash erased
+        c = *rle_in++;
+        if (c & 0x80)
+        {
+            rle_literal = 0;
+            rle_count = (c & 0x7F) + 3;
+            rle_value = rle_in < end ? *rle_in++ : 0xFF;
+        }
+        else
+        {
+            rle_literal = 1;
+            rle_count = c + 1;
+        }
+    }
+    rle_count--;
+    if (!rle_literal)
+        return rle_value;
+    return rle_in < end ? *rle_in++ : 0xFF;
+}
+
+static uint32_t source_next_word(void)
+{
+    uint32_t word;
+
+    if (!compressed)
+        return FlashAPIState.buffer[word_index++];
+    word = rle_next_byte();
+    word |= (uint32_t)rle_next_byte() << 8;
+    word |= (uint32_t)rle_next_byte() << 16;
+    word |= (uint32_t)rle_next_byte() << 24;
+    return word;
+}
+
+/**
+ * Checks the done state of the FTFA
+ * @return  <0 if there is an error, 0 if not ready, or 1 if ready without error
+ */
+static int32_t ftfa_is_done(void)
+{
+    if (FTFA_FSTAT & FTFA_FSTAT_CCIF_MASK)
+    {
+        if (FTFA_FSTAT & ~(FTFA_FSTAT_CCIF_MASK))
+        {
+            //there were errors
+            return -1;
+        }
+        else
+        {
+            //nothing but the ccif is active...no errors
+            return 1;
+        }
+    }
+
+    return 0;
+}
+
 static void api_tick(void)
 {
-    typedef enum { API_INIT, API_READY, API_PROGRAM_LOAD, API_PROGRAM_WAIT, API_FINISH, API_ERR } State;
+    typedef enum { API_INIT, API_READY, API_PROGRAM_LOAD, API_PROGRAM_WAIT, API_ERASE_LOAD, API_ERASE_WAIT, API_MASS_ERASE_WAIT, API_FINISH, API_ERR } State;
     static State state = API_INIT;
     static uint32_t current_index;
 
@@ -66,13 +166,32 @@ static void api_tick(void)
             uint8_t cmd = (FlashAPIState.status & API_STATUS_CMD_MASK) >> API_STATUS_CMD_SHIFT;
             switch (cmd)
             {
-            case API_STATUS_CMD_ERASE:
-                //flash mass erase
+            case API_STATUS_CMD_ERASE_SECTOR:
+                //erase length sectors starting at address
+                current_index = 0;
+                state = API_ERASE_LOAD;
+                break;
             case API_STATUS_CMD_PROGRAM:
                 //flash program
+                current_index = 0;
+                source_init(0);
+                state = API_PROGRAM_LOAD;
+                break;
+            case API_STATUS_CMD_PROGRAM_COMPRESSED:
+                //flash program, decompressing the buffer on the fly
+                current_index = 0;
+                source_init(1);
+                state = API_PROGRAM_LOAD;
+                break;
+            case API_STATUS_CMD_ERASE:
+                //flash mass erase, which also leaves the config field erased
+                FTFA_FCCOB0 = FCMD_ERSALL;
+                FCMD_START;
+                state = API_MASS_ERASE_WAIT;
+                break;
             default:
+                //report the command as not implemented and keep accepting others
                 FlashAPIState.status = API_STATUS_READY_MASK | API_STATUS_STATUS(API_STATUS_ERR_NOT_IMPLEMENTED);
-                state = API_ERR;
                 break;
             }
         }
@@ -86,12 +205,81 @@ static void api_tick(void)
         }
         else
         {
-            temp = FlashAPIState.address + (current_index & 0xFE) * 4;
+            temp = FlashAPIState.address + current_index * 4;
+            FTFA_FCCOB0 = FCMD_PROG;
+            FTFA_FCCOB1 = (temp & 0xFF0000) >> 16;
+            FTFA_FCCOB2 = (temp & 0xFF00) >> 8;
+            FTFA_FCCOB3 = (temp & 0xFF);
+            temp = source_next_word();
+            FTFA_FCCOB4 = (temp) >> 24;
+            FTFA_FCCOB5 = (temp & 0xFF0000) >> 16;
+            FTFA_FCCOB6 = (temp & 0xFF00) >> 8;
+            FTFA_FCCOB7 = (temp & 0xFF);
+            FCMD_START;
             state = API_PROGRAM_WAIT;
         }
         break;
     case API_PROGRAM_WAIT:
         //waits for the programming operation to complete
+        temp = ftfa_is_done();
+        if ((int32_t)temp < 0)
+        {
+            //a flash error occurred
+            FlashAPIState.status = API_STATUS_READY_MASK | API_STATUS_STATUS(API_STATUS_ERR_FLASH) | API_STATUS_ERROR(FTFA_FSTAT);
+            state = API_READY;
+        }
+        else if (temp > 0)
+        {
+            current_index++; //we just programmed a 4-byte longword
+            state = API_PROGRAM_LOAD;
+        }
+        break;
+    case API_ERASE_LOAD:
+        //loads the erase command for the current sector
+        //If we have erased all of the sectors, this calls API_FINISH
+        if (current_index >= FlashAPIState.length)
+        {
+            state = API_FINISH;
+        }
+        else
+        {
+            temp = FlashAPIState.address + current_index * SECTOR_SIZE;
+            FTFA_FCCOB0 = FCMD_SERASE;
+            FTFA_FCCOB1 = (temp & 0xFF0000) >> 16;
+            FTFA_FCCOB2 = (temp & 0xFF00) >> 8;
+            FTFA_FCCOB3 = (temp & 0xFF);
+            FCMD_START;
+            state = API_ERASE_WAIT;
+        }
+        break;
+    case API_ERASE_WAIT:
+        //waits for the sector erase to complete
+        temp = ftfa_is_done();
+        if ((int32_t)temp < 0)
+        {
+            //a flash error occurred
+            FlashAPIState.status = API_STATUS_READY_MASK | API_STATUS_STATUS(API_STATUS_ERR_FLASH) | API_STATUS_ERROR(FTFA_FSTAT);
+            state = API_READY;
+        }
+        else if (temp > 0)
+        {
+            current_index++;
+            state = API_ERASE_LOAD;
+        }
+        break;
+    case API_MASS_ERASE_WAIT:
+        //waits for the mass erase to complete
+        temp = ftfa_is_done();
+        if ((int32_t)temp < 0)
+        {
+            //a flash error occurred
+            FlashAPIState.status = API_STATUS_READY_MASK | API_STATUS_STATUS(API_STATUS_ERR_FLASH) | API_STATUS_ERROR(FTFA_FSTAT);
+            state = API_READY;
+        }
+        else if (temp > 0)
+        {
+            state = API_FINISH;
+        }
         break;
     case API_FINISH:
         //waits for the command to finish
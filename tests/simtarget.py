@@ -0,0 +1,344 @@
+"""
+Simulated Kinetis target for testing without hardware
+
+SimTarget stands in for an adapter at the readSWD/writeSWD level. It models
+the DP, a MEM-AP over RAM, flash and the debug registers, the MDM-AP and the
+flash loader's mailbox protocol, so that FlashProgrammer can be run against it
+end to end. make_loader writes a loader hex and map file for it to recognise.
+"""
+
+import os
+import struct
+from SWDErrors import *
+
+IDCODE = 0x0BC11477
+
+DHCSR = 0xE000EDF0
+DCRSR = 0xE000EDF4
+DCRDR = 0xE000EDF8
+DEMCR = 0xE000EDFC
+DFSR  = 0xE000ED30
+
+RAM_BASE = 0x1FFFFC00
+RAM_SIZE = 0x1000
+
+# offsets of the fake loader within RAM
+LOADER_VECTORS = 0x000
+LOADER_CONFIG  = 0x100
+LOADER_API     = 0x200
+LOADER_STAMP   = 0x310
+
+def write_intel_hex(name, addrdata):
+    """
+    Writes address/data tuples as an intel hex file
+    """
+    def record(kind, addr, data):
+        raw = bytes([len(data), (addr >> 8) & 0xFF, addr & 0xFF, kind]) + \
+            bytes(data)
+        return ':' + raw.hex().upper() + '{0:02X}\n'.format(-sum(raw) & 0xFF)
+    with open(name, 'w') as f:
+        upper = None
+        for (addr, data) in addrdata:
+            for off in range(0, len(data), 16):
+                a = addr + off
+                if a >> 16 != upper:
+                    upper = a >> 16
+                    f.write(record(0x04, 0, upper.to_bytes(2, 'big')))
+                f.write(record(0x00, a & 0xFFFF, data[off:off + 16]))
+        f.write(record(0x01, 0, b''))
+
+def make_loader(directory, type):
+    """
+    Writes firmware/<type>/bin/firmware.{hex,map} for a fake loader under
+    directory, returning the path to pass as FlashProgrammer's firmware_dir
+    """
+    firmware = os.path.join(directory, 'firmware')
+    bindir = os.path.join(firmware, type, 'bin')
+    os.makedirs(bindir)
+    image = bytearray(range(256)) * 2
+    image[LOADER_VECTORS:LOADER_VECTORS + 8] = struct.pack('<II',
+        RAM_BASE + RAM_SIZE, RAM_BASE + 0x41)
+    image[LOADER_CONFIG:LOADER_CONFIG + 16] = b'\xff' * 12 + b'\xfe\xff\xff\xff'
+    write_intel_hex(os.path.join(bindir, 'firmware.hex'), [(RAM_BASE, image)])
+    with open(os.path.join(bindir, 'firmware.map'), 'w') as f:
+        for (name, off) in [('interrupt_vector_table', LOADER_VECTORS),
+            ('unsecured_config', LOADER_CONFIG),
+            ('flash_api_state', LOADER_API), ('loader_stamp', LOADER_STAMP)]:
+            f.write(' .{0:<24} 0x{1:08x}       0x10\n'.format(name,
+                RAM_BASE + off))
+    return firmware
+
+class SimTarget(object):
+    def __init__(self, flash_size=0x2000, sector_size=512,
+        commands=(0, 1, 3, 4), sticky_errors=False, sdid=0):
+        """
+        A target running the fake loader
+        commands: Loader commands which are implemented
+        sticky_errors: Emulate older loaders, which stop responding after
+            reporting a command as not implemented
+        sdid: Value read from the device ID register
+        """
+        self.flash = bytearray(b'\xff' * flash_size)
+        self.sector_size = sector_size
+        self.commands = commands
+        self.sticky_errors = sticky_errors
+        self.ram = {}
+        self.io = {0x40048000: sdid, 0x40048024: sdid}
+        self.transactions = 0
+        self.clockRate = None
+        # DP
+        self.ctrl = 0
+        self.select = 0
+        self.rdbuff = 0
+        # MEM-AP
+        self.csw = 0x02
+        self.tar = 0
+        # core
+        self.regs = [0] * 32
+        self.dcrdr = 0
+        self.demcr = 0
+        self.debugen = False
+        self.halted = False
+        self.reset_st = False
+        self.in_reset = False
+        self.core_hold = False
+        self.loader = False
+        self.dead = False
+        self.log = []
+        # error injection: addresses whose writes FAULT, and a target which
+        # answers every AP write with WAIT
+        self.sticky = 0
+        self.faults = set()
+        self.busy = False
+
+    def setClockRate(self, rate):
+        self.clockRate = rate
+
+    def lineReset(self):
+        self.transactions += 1
+        return IDCODE
+
+    # core
+
+    def __start(self):
+        self.halted = False
+        self.loader = self.regs[15] == RAM_BASE + 0x41
+        if self.loader:
+            self.dead = False
+            self.__write_ram(RAM_BASE + LOADER_API, 0x8)
+
+    def __reset(self):
+        self.regs = [0] * 32
+        self.reset_st = True
+        self.loader = False
+        self.halted = False
+
+    def __release(self):
+        if self.demcr & 0x1:
+            self.halted = True
+        else:
+            self.regs[15] = 0
+            self.__start()
+
+    # memory
+
+    def __read_ram(self, addr):
+        return self.ram.get(addr & ~3, 0)
+
+    def __write_ram(self, addr, value):
+        self.ram[addr & ~3] = value & 0xFFFFFFFF
+
+    def read_word(self, addr):
+        addr &= ~3
+        if addr < len(self.flash):
+            return struct.unpack_from('<I', self.flash, addr)[0]
+        if RAM_BASE <= addr < RAM_BASE + RAM_SIZE:
+            return self.__read_ram(addr)
+        if addr == DHCSR:
+            value = (0x02000000 if self.reset_st else 0) | \
+                (0x00020000 if self.halted else 0) | 0x00010000 | \
+                (0x1 if self.debugen else 0) | (0x2 if self.halted else 0)
+            self.reset_st = False
+            return value
+        if addr == DCRDR:
+            return self.dcrdr
+        if addr == DEMCR:
+            return self.demcr
+        return self.io.get(addr, 0)
+
+    def write_word(self, addr, value):
+        addr &= ~3
+        if RAM_BASE <= addr < RAM_BASE + RAM_SIZE:
+            self.__write_ram(addr, value)
+            if addr == RAM_BASE + LOADER_API and self.loader and \
+                not value & 0x8:
+                self.__command(value & 0x7)
+        elif addr == DHCSR and value >> 16 == 0xA05F:
+            self.debugen = bool(value & 0x1)
+            halt = self.debugen and bool(value & 0x2)
+            if self.halted and not halt:
+                self.__start()
+            self.halted = halt
+        elif addr == DCRSR:
+            if value & 0x10000:
+                self.regs[value & 0x1F] = self.dcrdr
+            else:
+                self.dcrdr = self.regs[value & 0x1F]
+        elif addr == DCRDR:
+            self.dcrdr = value
+        elif addr == DEMCR:
+            self.demcr = value
+        elif addr < len(self.flash) or addr == DFSR:
+            pass
+        else:
+            self.io[addr] = value
+
+    # loader
+
+    def __command(self, cmd):
+        api = RAM_BASE + LOADER_API
+        if self.dead:
+            return
+        self.log.append(cmd)
+        if cmd not in self.commands:
+            self.__write_ram(api, 0xF8)
+            self.dead = self.sticky_errors
+            return
+        addr = self.__read_ram(api + 4)
+        length = self.__read_ram(api + 8)
+        buf = b''.join(struct.pack('<I', self.__read_ram(api + 12 + 4 * i))
+            for i in range(64))
+        if cmd == 0:
+            self.flash[:] = b'\xff' * len(self.flash)
+        elif cmd == 3:
+            start = addr - addr % self.sector_size
+            end = start + length * self.sector_size
+            self.flash[start:end] = b'\xff' * (end - start)
+        else:
+            data = buf[:length * 4] if cmd == 1 else \
+                self.__decompress(buf, length * 4)
+            for (i, b) in enumerate(data):
+                self.flash[addr + i] &= b
+        self.__write_ram(api, 0x8)
+
+    @staticmethod
+    def __decompress(buf, length):
+        out = bytearray()
+        i = 0
+        while len(out) < length:
+            c = buf[i]
+            if c & 0x80:
+                out.extend(buf[i + 1:i + 2] * ((c & 0x7F) + 3))
+                i += 2
+            else:
+                out.extend(buf[i + 1:i + 2 + c])
+                i += c + 2
+        return bytes(out[:length])
+
+    # APs
+
+    def __ap_read(self, apsel, addr):
+        if apsel == 1:
+            if addr == 0x00:
+                return 0x2 | (0 if self.in_reset else 0x8)
+            if addr == 0x04:
+                return (0x8 if self.in_reset else 0) | \
+                    (0x10 if self.core_hold else 0)
+            return 0x001C0000
+        if addr == 0x00:
+            return 0x23000040 | self.csw
+        if addr == 0x04:
+            return self.tar
+        if addr == 0x0C:
+            size = 1 << (self.csw & 0x7)
+            value = self.read_word(self.tar)
+            self.__increment(size)
+            return value
+        if addr == 0xFC:
+            return 0x04770031
+        return 0
+
+    def __ap_write(self, apsel, addr, data):
+        if apsel == 1:
+            if addr == 0x04:
+                if data & 0x1:
+                    self.flash[:] = b'\xff' * len(self.flash)
+                reset = bool(data & 0x8)
+                hold = bool(data & 0x10)
+                if reset and not self.in_reset:
+                    self.__reset()
+                if (self.in_reset or self.core_hold) and not reset and \
+                    not hold:
+                    self.__release()
+                self.in_reset = reset
+                self.core_hold = hold
+            return
+        if addr == 0x00:
+            # no packed transfers
+            self.csw = data & 0x37 if (data >> 4) & 0x3 != 2 else data & 0x07
+        elif addr == 0x04:
+            self.tar = data
+        elif addr == 0x0C:
+            size = 1 << (self.csw & 0x7)
+            if size == 4:
+                self.write_word(self.tar, data)
+            else:
+                shift = (self.tar & 3) * 8
+                mask = ((1 << (size * 8)) - 1) << shift
+                word = self.read_word(self.tar)
+                self.write_word(self.tar, (word & ~mask) | (data & mask))
+            self.__increment(size)
+
+    def __increment(self, size):
+        if (self.csw >> 4) & 0x3:
+            self.tar = (self.tar & ~0x3FF) | ((self.tar + size) & 0x3FF)
+
+    # adapter interface
+
+    def readSWD(self, ap, register):
+        self.transactions += 1
+        if ap:
+            if self.sticky & 0xA2:
+                raise SWDFaultError()
+            value = self.rdbuff
+            self.rdbuff = self.__ap_read(self.select >> 24,
+                (self.select & 0xF0) | (register << 2))
+            return value
+        if register == 0:
+            return IDCODE
+        if register == 1:
+            return (self.ctrl & 0x5400000F) | 0xA0000000 | self.sticky
+        if register == 3:
+            return self.rdbuff
+        return 0
+
+    def __ap_error(self, ignoreACK):
+        """
+        With a sticky error set, or WAIT under overrun detection, the AP is not
+        accessed. The ACK is only reported when it is not being ignored.
+        """
+        if not ignoreACK:
+            raise SWDWaitError() if self.busy else SWDFaultError()
+
+    def writeSWD(self, ap, register, data, ignoreACK=False):
+        self.transactions += 1
+        if ap:
+            if self.sticky & 0xA2:
+                return self.__ap_error(ignoreACK)
+            if self.busy and self.ctrl & 0x1:
+                self.sticky |= 0x2
+                return self.__ap_error(ignoreACK)
+            addr = (self.select & 0xF0) | (register << 2)
+            if self.select >> 24 == 0 and addr == 0x0C and \
+                self.tar & ~3 in self.faults:
+                self.sticky |= 0x20
+                return self.__ap_error(ignoreACK)
+            self.__ap_write(self.select >> 24, addr, data)
+        elif register == 0:
+            self.sticky &= ~((0x2 if data & 0x10 else 0) |
+                (0x80 if data & 0x08 else 0) | (0x20 if data & 0x04 else 0) |
+                (0x10 if data & 0x02 else 0))
+        elif register == 1:
+            self.ctrl = data
+        elif register == 2:
+            self.select = data
@@ -0,0 +1,78 @@
+"""
+Checks the lean programming path against its SWD transaction budget on a
+simulated target, so that no hardware is needed. When a change legitimately
+alters the counts, update the budgets here along with it.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from simtarget import *
+from SWDCommon import *
+from Kinetis import *
+from FlashProgrammer import *
+
+# image with code, the flash configuration field and a run-length friendly
+# block spread over three sectors
+IMAGE = [
+    (0x000, bytes(range(64))),
+    (0x400, b'\xff' * 12 + b'\xfe\xff\xff\xff'),
+    (0x800, bytes([7]) * 300),
+]
+
+# loader uploaded on a fresh board
+BUDGET = { 'connect': 29, 'load': 311, 'erase': 46, 'program': 79, 'reset': 11 }
+# loader already resident and device profile cached from the previous run
+RESIDENT_BUDGET = dict(BUDGET, connect=19, load=170)
+
+class BudgetTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.firmware = make_loader(self.dir, 'KE04')
+        self.hexfile = os.path.join(self.dir, 'image.hex')
+        write_intel_hex(self.hexfile, IMAGE)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def program(self, target, budget):
+        dp = DebugPort(target)
+        dp.init()
+        prog = FlashProgrammer(Kinetis(dp), 'KE04', lean=True, budget=budget,
+            firmware_dir=self.firmware)
+        return (prog, prog.program(self.hexfile))
+
+    def assertProgrammed(self, target):
+        for (addr, data) in IMAGE:
+            self.assertEqual(bytes(target.flash[addr:addr + len(data)]), data)
+
+    def test_lean_within_budget(self):
+        target = SimTarget()
+        (prog, transactions) = self.program(target, BUDGET)
+        self.assertProgrammed(target)
+        for (phase, limit) in BUDGET.items():
+            self.assertLessEqual(transactions[phase], limit, phase)
+
+    def test_resident_loader_within_budget(self):
+        target = SimTarget()
+        (prog, transactions) = self.program(target, BUDGET)
+        transactions = prog.program(self.hexfile)
+        self.assertProgrammed(target)
+        for (phase, limit) in RESIDENT_BUDGET.items():
+            self.assertLessEqual(transactions[phase], limit, phase)
+
+    def test_over_budget_fails(self):
+        with self.assertRaises(TransactionBudgetError):
+            self.program(SimTarget(), dict(BUDGET, program=10))
+
+    def test_older_loader_fallbacks(self):
+        # without sector erase or compressed program, and stuck after
+        # reporting a command as not implemented
+        target = SimTarget(commands=(0, 1), sticky_errors=True)
+        self.program(target, None)
+        self.assertProgrammed(target)
+        self.assertEqual(target.log[:3], [3, 0, 1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+"""
+Checks which failed transactions the clock tuner repeats
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from simtarget import *
+from SWDCommon import *
+from SWDClockTuner import *
+
+class CorruptAck(object):
+    """
+    Performs transactions but reports a corrupted ACK for the one which is
+    countdown transactions of the matching kind away
+    """
+    def __init__(self, target, ap):
+        self.target = target
+        self.ap = ap
+        self.countdown = 0
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+    def __corrupt(self, ap, result):
+        if self.countdown and ap == self.ap:
+            self.countdown -= 1
+            if not self.countdown:
+                raise SWDProtocolError()
+        return result
+
+    def readSWD(self, ap, register):
+        return self.__corrupt(ap, self.target.readSWD(ap, register))
+
+    def writeSWD(self, ap, register, data, ignoreACK=False):
+        return self.__corrupt(ap, self.target.writeSWD(ap, register, data,
+            ignoreACK))
+
+class WaitThenCorrupt(object):
+    """
+    Answers one AP data write with WAIT, then reports a corrupted ACK for
+    the CTRL/STAT read which follows it
+    """
+    def __init__(self, target):
+        self.target = target
+        self.countdown = 0
+        self.waited = False
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+    def readSWD(self, ap, register):
+        result = self.target.readSWD(ap, register)
+        if self.waited and not ap and register == 1:
+            self.waited = False
+            raise SWDProtocolError()
+        return result
+
+    def writeSWD(self, ap, register, data, ignoreACK=False):
+        if self.countdown and ap and register == 3:
+            self.countdown -= 1
+            if not self.countdown:
+                self.waited = True
+                self.target.busy = True
+        try:
+            return self.target.writeSWD(ap, register, data, ignoreACK)
+        finally:
+            self.target.busy = False
+
+class ClockTunerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.target = SimTarget()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def connect(self, ap, link=None):
+        self.link = link or CorruptAck(self.target, ap)
+        tuner = ClockTuner(self.link, 'test',
+            store=os.path.join(self.dir, 'fixtures.json'))
+        dp = DebugPort(tuner)
+        dp.init()
+        return MEM_AP(dp, 0)
+
+    def test_ap_write_is_not_repeated(self):
+        ahb = self.connect(True)
+        ahb.writeBlock(RAM_BASE, [0, 0])
+        # the first data write after the TAR lands but its ACK is lost, so
+        # repeating it would put the word at the next address
+        self.link.countdown = 2
+        with self.assertRaises(SWDProtocolError):
+            ahb.writeBlockFast(RAM_BASE, [1, 2])
+        self.assertEqual(self.target.read_word(RAM_BASE + 4), 0)
+
+    def test_dp_read_is_repeated(self):
+        ahb = self.connect(False)
+        self.link.countdown = 1
+        self.assertEqual(ahb.dp.idcode(), IDCODE)
+
+    def test_repeated_status_read_reports_overrun(self):
+        ahb = self.connect(False, WaitThenCorrupt(self.target))
+        words = list(range(1, 9))
+        self.link.countdown = 3
+        ahb.writeBlockStream(RAM_BASE, words)
+        self.assertEqual(ahb.readBlock(RAM_BASE, len(words)), words)
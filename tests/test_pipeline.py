@@ -0,0 +1,72 @@
+"""
+Checks preparing jobs over the process pool
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from simtarget import *
+from JobPipeline import *
+
+SHM_DIR = '/dev/shm'
+
+def blocks():
+    return set(n for n in os.listdir(SHM_DIR) if n.startswith('psm_'))
+
+@unittest.skipUnless(os.path.isdir(SHM_DIR), "shared memory is not listed")
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.hexfile = os.path.join(self.dir, 'image.hex')
+        write_intel_hex(self.hexfile, [(0x000, bytes(range(64))),
+            (0x800, bytes([7]) * 300)])
+        self.template = PatchTemplate([('serial', 0x10, 'u32', None)])
+        self.before = blocks()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        self.assertEqual(blocks(), self.before)
+
+    def jobs(self, count, hexfile=None):
+        # every other job is unpatched, which must not see earlier serials
+        for i in range(count):
+            yield Job(str(i), 'KE04', hexfile or self.hexfile,
+                self.template if i % 2 else None, { 'serial': str(i) })
+
+    def test_order_and_crcs(self):
+        pipeline = JobPipeline(self.jobs(10), workers=2, depth=2)
+        try:
+            for (i, image) in enumerate(pipeline):
+                try:
+                    self.assertEqual(image.job.name, str(i))
+                    (addr, data) = image.chunks[0]
+                    self.assertEqual(struct.unpack_from('<I', data, 0x10)[0],
+                        i if i % 2 else 0x13121110)
+                    self.assertEqual(image.crcs, [zlib.crc32(data) for \
+                        (addr, data) in image.chunks])
+                finally:
+                    image.release()
+            self.assertEqual(i, 9)
+        finally:
+            pipeline.close()
+
+    def test_close_releases_untaken(self):
+        pipeline = JobPipeline(self.jobs(10), workers=2, depth=2)
+        pipeline.get().release()
+        pipeline.close()
+
+    def test_failing_job(self):
+        missing = os.path.join(self.dir, 'missing.hex')
+        jobs = list(self.jobs(2)) + list(self.jobs(2, missing))
+        pipeline = JobPipeline(jobs, workers=2, depth=2)
+        try:
+            with self.assertRaises(IOError):
+                for image in pipeline:
+                    image.release()
+        finally:
+            pipeline.close()
+
+if __name__ == '__main__':
+    unittest.main()
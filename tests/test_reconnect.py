@@ -0,0 +1,26 @@
+"""
+Checks that reconnecting to a new board leaves the AHB-AP usable
+"""
+
+import unittest
+from simtarget import *
+from SWDCommon import *
+from Kinetis import *
+
+class ReconnectTest(unittest.TestCase):
+    def test_reads_after_reconnect(self):
+        target = SimTarget()
+        dp = DebugPort(target)
+        dp.init()
+        dev = Kinetis(dp)
+        dev.ahb.writeBlockFast(RAM_BASE, [0x03020100, 0x07060504,
+            0x0b0a0908, 0x0f0e0d0c])
+        # a new board comes up with CSW at its reset value, without AddrInc
+        target.csw = 0x02
+        dev.reconnect()
+        buf = bytearray(16)
+        dev.read_into(RAM_BASE, buf)
+        self.assertEqual(bytes(buf), bytes(range(16)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+"""
+Checks how streamed MEM-AP writes handle errors whose ACKs were ignored
+"""
+
+import unittest
+from simtarget import *
+from SWDCommon import *
+from SWDErrors import *
+
+class StreamTest(unittest.TestCase):
+    def setUp(self):
+        self.target = SimTarget()
+        self.dp = DebugPort(self.target)
+        self.dp.init()
+        self.ahb = MEM_AP(self.dp, 0)
+        self.words = list(range(1, 65))
+
+    def test_stream_lands(self):
+        self.ahb.writeBlockStream(RAM_BASE, self.words)
+        self.assertEqual(self.ahb.readBlock(RAM_BASE, 64), self.words)
+
+    def test_fault_raises(self):
+        self.target.faults.add(RAM_BASE + 0x40)
+        with self.assertRaises(SWDFaultError):
+            self.ahb.writeBlockStream(RAM_BASE, self.words)
+        # the sticky error was cleared, so the link is usable again
+        self.target.faults.clear()
+        self.ahb.writeWord(RAM_BASE, 0x1234)
+        self.assertEqual(self.ahb.readWord(RAM_BASE), 0x1234)
+
+    def test_replays_are_bounded(self):
+        self.target.busy = True
+        with self.assertRaises(SWDWaitError):
+            self.ahb.writeBlockStream(RAM_BASE, self.words)
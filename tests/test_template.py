@@ -0,0 +1,57 @@
+"""
+Checks resolving template fields through a gcc map file
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from FlashProgrammer import *
+
+MAP = """\
+ .text          0x00000000      0x200
+ .bss           0x1ffffe00       0x40
+ .bss.mac_address
+                0x1ffffe10        0x6 ./obj/main.o
+                0x1ffffe10                mac_address
+ .bss           0x1ffffe18        0x4 ./obj/serial.o
+                0x1ffffe18                serial_number
+                0x1ffffe40                _end_bss = .
+"""
+
+class TemplateTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.mapname = os.path.join(self.dir, 'image.map')
+        with open(self.mapname, 'w') as f:
+            f.write(MAP)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def template(self, spec):
+        name = os.path.join(self.dir, 'template.json')
+        with open(name, 'w') as f:
+            json.dump(spec, f)
+        return PatchTemplate.from_json(name, self.mapname)
+
+    def test_symbols_and_sections(self):
+        template = self.template({
+            'mac': { 'symbol': 'mac_address', 'format': 'bytes', 'length': 6 },
+            'serial': { 'symbol': 'serial_number', 'format': 'u32' },
+            'text': { 'symbol': 'text', 'format': 'u8' } })
+        self.assertEqual(template.fields, [
+            ('mac', 0x1ffffe10, 'bytes', 6),
+            ('serial', 0x1ffffe18, 'u32', None),
+            ('text', 0x0, 'u8', None)])
+
+    def test_unknown_symbol(self):
+        with self.assertRaises(InvalidDataException):
+            self.template({ 'x': { 'symbol': '_end_bss', 'format': 'u8' } })
+
+    def test_length_required(self):
+        for format in ('bytes', 'ascii'):
+            with self.assertRaisesRegex(InvalidDataException, 'name'):
+                self.template({ 'name': { 'address': '0x1f00',
+                    'format': format } })
@@ -0,0 +1,61 @@
+"""
+Checks recording a programming session, replaying it and analysing the trace
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from simtarget import *
+from SWDCommon import *
+from SWDTrace import *
+from Kinetis import *
+from FlashProgrammer import *
+
+IMAGE = [
+    (0x000, bytes(range(64))),
+    (0x800, bytes([7]) * 300),
+]
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.firmware = make_loader(self.dir, 'KE04')
+        self.hexfile = os.path.join(self.dir, 'image.hex')
+        write_intel_hex(self.hexfile, IMAGE)
+        self.trace = os.path.join(self.dir, 'session.trace')
+        recorder = TraceRecorder(SimTarget(), self.trace)
+        try:
+            self.recorded = self.program(recorder, self.hexfile)
+        finally:
+            recorder.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def program(self, adapter, hexfile):
+        dp = DebugPort(adapter)
+        dp.init()
+        prog = FlashProgrammer(Kinetis(dp), 'KE04', lean=True,
+            firmware_dir=self.firmware)
+        return prog.program(hexfile)
+
+    def test_replay(self):
+        replayed = self.program(TraceReplayer(self.trace), self.hexfile)
+        self.assertEqual(replayed, self.recorded)
+
+    def test_replay_mismatch(self):
+        other = os.path.join(self.dir, 'other.hex')
+        write_intel_hex(other, [(0x000, bytes(range(1, 65)))] + IMAGE[1:])
+        with self.assertRaises(TraceMismatchError):
+            self.program(TraceReplayer(self.trace), other)
+
+    def test_analyse(self):
+        summary = analyse(self.trace)
+        for (phase, count) in self.recorded.items():
+            self.assertEqual(summary.phases[phase][0], count, phase)
+        lines = str(summary).splitlines()
+        self.assertEqual(len(lines[0]), len(lines[1]))
+
+if __name__ == '__main__':
+    unittest.main()
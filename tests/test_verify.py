@@ -0,0 +1,53 @@
+"""
+Checks reading the flash back against the image checksums
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from simtarget import *
+from SWDCommon import *
+from Kinetis import *
+from FlashProgrammer import *
+
+class StuckBit(SimTarget):
+    "A target whose flash reads back with one bit stuck low"
+    def read_word(self, addr):
+        value = SimTarget.read_word(self, addr)
+        return value & ~0x1 if addr & ~3 == 0x900 else value
+
+class VerifyTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.firmware = make_loader(self.dir, 'KE04')
+        self.image = FlashImage([(0x000, bytes(range(64))),
+            (0x800, bytes([7]) * 300)])
+        self.image.patch(0x904, b'\x01\x02\x03\x04')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def program(self, target):
+        dp = DebugPort(target)
+        dp.init()
+        prog = FlashProgrammer(Kinetis(dp), 'KE04', lean=True, verify=True,
+            firmware_dir=self.firmware)
+        return prog.program(self.image)
+
+    def test_verify_passes(self):
+        transactions = self.program(SimTarget())
+        self.assertIn('verify', transactions)
+
+    def test_verify_detects_mismatch(self):
+        with self.assertRaises(VerifyException):
+            self.program(StuckBit())
+
+    def test_recovery_without_mass_erase(self):
+        # the error is still raised, and the configuration field is left
+        # unsecured although the firmware cannot mass erase
+        target = StuckBit(commands=(1, 3, 4))
+        with self.assertRaises(VerifyException):
+            self.program(target)
+        self.assertEqual(bytes(target.flash[0x400:0x410]),
+            b'\xff' * 12 + b'\xfe\xff\xff\xff')